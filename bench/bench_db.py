@@ -0,0 +1,262 @@
+"""Storage benchmark for db.py.
+
+Fills a throwaway database with synthetic messages in steps (10^4 to 10^6 by default,
+pass --scales up to 10^7) and measures the queries the client runs, reporting latency percentiles
+for every step:
+
+    python bench/bench_db.py --scales 10000 100000 1000000 --output results.json
+    python bench/bench_db.py --compare results.json
+
+Results are written as JSON (with the commit they were measured on), and ``--compare``
+prints the change of every p50 against an earlier result file.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from typing import Callable, Optional
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src")
+sys.path.insert(0, SRC_DIR)
+
+SERVER_URL = "http://bench.invalid"
+USERS = 50
+TEXTS = [
+    "ok",
+    "收到",
+    "See you tomorrow at the usual place.",
+    "这个问题我明天再看一下，先把日志发我。",
+    "A longer message that wraps over a couple of lines in the chat view, "
+    "like the ones people paste when they explain what went wrong. " * 3,
+]
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    """Milliseconds at p50/p90/p99, plus mean and max, of samples in nanoseconds."""
+    data = sorted(samples)
+
+    def at(p: float) -> float:
+        return data[min(len(data) - 1, round(p / 100 * (len(data) - 1)))] / 1e6
+
+    return {
+        "n": len(data),
+        "p50": at(50),
+        "p90": at(90),
+        "p99": at(99),
+        "mean": sum(data) / len(data) / 1e6,
+        "max": data[-1] / 1e6,
+    }
+
+
+def measure(fn: Callable[[], object], repeat: int) -> dict[str, float]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        fn()
+        samples.append(time.perf_counter_ns() - start)
+    return percentiles(samples)
+
+
+class Bench:
+    def __init__(self, groups: int, repeat: int, seed: int):
+        import db
+        self.db = db
+        self.groups = groups
+        self.repeat = repeat
+        self.random = random.Random(seed)
+        self.count = 0
+        # Next msgid of every group
+        self.next_msgid = {group_id: 1 for group_id in range(1, groups + 1)}
+        self.base_time = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+        db.save_server_to_db("bench", SERVER_URL)
+        self.server_id = db.get_server_from_db(SERVER_URL).id
+        for i in range(USERS):
+            db.add_nickname(self.server_id, f"user{i}", f"User {i}")
+        # What get_file_size needs from a StealthIM.Group for a cache hit
+        self.group = types.SimpleNamespace(
+            group_id=1, user=types.SimpleNamespace(server=types.SimpleNamespace(url=SERVER_URL))
+        )
+        self.hashes = [f"{i:064x}" for i in range(1000)]
+        for file_hash in self.hashes:
+            db.add_file_size(self.server_id, 1, file_hash, 1024)
+
+    def _row(self, group_id: int) -> dict:
+        msgid = self.next_msgid[group_id]
+        self.next_msgid[group_id] += 1
+        file_msg = self.random.random() < 0.05
+        return {
+            "server_id": self.server_id,
+            "group_id": group_id,
+            "type": 4 if file_msg else 0,
+            "msgid": msgid,
+            "msg": "report.pdf" if file_msg else self.random.choice(TEXTS),
+            "time": self.base_time + datetime.timedelta(seconds=msgid * 30),
+            "username": f"user{self.random.randrange(USERS)}",
+            "hash": self.random.choice(self.hashes) if file_msg else "",
+        }
+
+    def fill(self, total: int, chunk: int = 50000) -> float:
+        """Grow the messages table to ``total`` rows, returns the rows per second."""
+        table = self.db.Message.__table__
+        start = time.perf_counter()
+        added = 0
+        while self.count < total:
+            n = min(chunk, total - self.count)
+            rows = [self._row(self.random.randint(1, self.groups)) for _ in range(n)]
+            with self.db.engine.begin() as conn:
+                conn.execute(table.insert(), rows)
+            self.count += n
+            added += n
+        elapsed = time.perf_counter() - start
+        return added / elapsed if elapsed else 0
+
+    def _group(self) -> int:
+        return self.random.randint(1, self.groups)
+
+    def _msgid(self, group_id: int) -> int:
+        return self.random.randint(1, self.next_msgid[group_id])
+
+    def run(self) -> dict[str, dict]:
+        db = self.db
+        server_id = self.server_id
+        repeat = self.repeat
+        results = {}
+
+        results["get_latest_messages"] = measure(
+            lambda: db.get_latest_messages(server_id, self._group(), 100), repeat)
+
+        def messages(old_to_new: bool) -> None:
+            group_id = self._group()
+            db.get_messages(server_id, group_id, self._msgid(group_id), old_to_new, 100)
+
+        results["get_messages_older"] = measure(lambda: messages(False), repeat)
+        results["get_messages_newer"] = measure(lambda: messages(True), repeat)
+        results["get_group_msgid_latest"] = measure(
+            lambda: db.get_group_msgid(self._group(), server_id, True), repeat)
+        results["get_group_msgid_oldest"] = measure(
+            lambda: db.get_group_msgid(self._group(), server_id, False), repeat)
+
+        def add_message() -> None:
+            group_id = self._group()
+            row = self._row(group_id)
+            db.add_message(server_id, group_id, row["type"], row["msg"], row["time"],
+                           row["username"], row["msgid"], row["hash"])
+
+        start = time.perf_counter()
+        results["add_message"] = measure(add_message, repeat)
+        results["add_message"]["rate"] = repeat / (time.perf_counter() - start)
+        self.count += repeat
+
+        loop = asyncio.new_event_loop()
+        try:
+            results["get_nickname"] = measure(lambda: loop.run_until_complete(
+                db.get_nickname(server_id, None, f"user{self.random.randrange(USERS)}")), repeat)
+            results["get_file_size"] = measure(lambda: loop.run_until_complete(
+                db.get_file_size(self.group, self.random.choice(self.hashes))), repeat)
+        finally:
+            loop.close()
+
+        def add_file_size() -> None:
+            file_hash = f"{self.random.getrandbits(256):064x}"
+            db.add_file_size(server_id, 1, file_hash, 1024)
+            # Keep self.hashes what is in the table, so later lookups stay cache hits
+            self.hashes.pop(0)
+            self.hashes.append(file_hash)
+
+        # The table is full (1000 rows), every add evicts the oldest entry
+        results["add_file_size_evict"] = measure(add_file_size, repeat)
+        return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SRC_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(scale: int, fill_rate: float, results: dict[str, dict]) -> None:
+    print(f"\n{scale} messages (filled at {fill_rate:.0f} rows/s)")
+    print(f"  {'operation':<24}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}  ms")
+    for name, stat in results.items():
+        line = f"  {name:<24}{stat['p50']:>10.3f}{stat['p90']:>10.3f}{stat['p99']:>10.3f}{stat['max']:>10.3f}"
+        if "rate" in stat:
+            line += f"  ({stat['rate']:.0f}/s)"
+        print(line)
+
+
+def compare(current: dict, baseline_path: str) -> None:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\np50 against {baseline_path} ({baseline.get('commit')})")
+    old_runs = {run["scale"]: run["results"] for run in baseline["runs"]}
+    for run in current["runs"]:
+        old = old_runs.get(run["scale"])
+        if not old:
+            continue
+        print(f"  {run['scale']} messages")
+        for name, stat in run["results"].items():
+            if name not in old:
+                continue
+            change = (stat["p50"] / old[name]["p50"] - 1) * 100 if old[name]["p50"] else 0
+            print(f"    {name:<24}{old[name]['p50']:>10.3f} -> {stat['p50']:>10.3f} ms  {change:+.1f}%")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scales", type=int, nargs="+", default=[10 ** 4, 10 ** 5, 10 ** 6],
+                        help="message counts to measure at, the database grows through them")
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=200, help="calls per operation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", help="database file to use (default: a temporary file)")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="earlier JSON results to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, "bench.sqlite")
+        if os.path.exists(path):
+            parser.error(f"{path} already exists")
+        os.environ["STEALTHIM_DB_PATH"] = path
+        bench = Bench(args.groups, args.repeat, args.seed)
+
+        report = {
+            "commit": git_commit(),
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "groups": args.groups,
+            "repeat": args.repeat,
+            "runs": [],
+        }
+        for scale in sorted(args.scales):
+            fill_rate = bench.fill(scale)
+            results = bench.run()
+            print_results(scale, fill_rate, results)
+            report["runs"].append({"scale": scale, "fill_rate": fill_rate, "results": results})
+        bench.db.engine.dispose()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
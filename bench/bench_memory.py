@@ -0,0 +1,117 @@
+"""Memory benchmark of the messages the chat screen keeps.
+
+Fills a throwaway database with synthetic messages of one group (10^5 by default), loads
+them the way the chat screen does and measures with tracemalloc what that allocates:
+the peak while loading from the database, and what the message list keeps afterwards,
+in bytes and allocations per message:
+
+    python bench/bench_memory.py --messages 100000 --output memory.json
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+
+from bench_db import SERVER_URL, TEXTS, USERS, git_commit
+
+GROUP_ID = 1
+
+
+def fill(db, server_id: int, count: int, seed: int) -> None:
+    rng = random.Random(seed)
+    base_time = datetime.datetime(2024, 1, 1)
+    table = db.Message.__table__
+    for start in range(1, count + 1, 50000):
+        with db.engine.begin() as conn:
+            conn.execute(table.insert(), [{
+                "server_id": server_id,
+                "group_id": GROUP_ID,
+                "type": 0,
+                "msgid": msgid,
+                "msg": rng.choice(TEXTS),
+                "time": base_time + datetime.timedelta(seconds=msgid * 30),
+                "username": f"user{rng.randrange(USERS)}",
+                "hash": "",
+            } for msgid in range(start, min(count + 1, start + 50000))])
+
+
+def measure(count: int, seed: int) -> dict:
+    import db
+    from screens.chat import ChatScreen
+
+    db.save_server_to_db("bench", SERVER_URL)
+    server_id = db.get_server_from_db(SERVER_URL).id
+    fill(db, server_id, count, seed)
+
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.take_snapshot()
+    start = time.perf_counter()
+    # What show_latest and load_older do, with a page of every message
+    rows = db.get_latest_messages(server_id, GROUP_ID, limit=count)
+    loaded = time.perf_counter() - start
+    messages = [ChatScreen.build_msg_from_db(row) for row in rows]
+    built = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    del rows
+    gc.collect()
+    kept = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    assert len(messages) == count
+    diff = kept.compare_to(base, "filename")
+    kept_size = sum(stat.size_diff for stat in diff)
+    kept_count = sum(stat.count_diff for stat in diff)
+    return {
+        "messages": count,
+        "load_ms": loaded * 1000,
+        "build_ms": (built - loaded) * 1000,
+        "peak_bytes": peak,
+        "kept_bytes": kept_size,
+        "kept_allocations": kept_count,
+        "peak_per_message": peak / count,
+        "kept_per_message": kept_size / count,
+        "allocations_per_message": kept_count / count,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["STEALTHIM_DB_PATH"] = os.path.join(tmp, "bench.sqlite")
+        import db
+        results = measure(args.messages, args.seed)
+        db.engine.dispose()
+
+    print(f"{results['messages']} messages")
+    print(f"  load from database  {results['load_ms']:>10.0f} ms")
+    print(f"  build rows          {results['build_ms']:>10.0f} ms")
+    print(f"  peak                {results['peak_bytes'] / 2 ** 20:>10.1f} MiB  "
+          f"({results['peak_per_message']:.0f} B/message)")
+    print(f"  kept                {results['kept_bytes'] / 2 ** 20:>10.1f} MiB  "
+          f"({results['kept_per_message']:.0f} B/message, "
+          f"{results['allocations_per_message']:.1f} allocations/message)")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "commit": git_commit(),
+                "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "results": results,
+            }, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
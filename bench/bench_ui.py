@@ -0,0 +1,317 @@
+"""Headless UI benchmark for the chat screen.
+
+Runs ``IMApp`` with ``App.run_test()`` against the stand-in server of fake_server.py
+and times what users notice: switching groups, rendering a long history, incoming
+messages (one at a time and in bursts), loading older messages at the top, and scrolling with the message selector
+open. Every measurement has a p90 budget and the run fails when one is exceeded:
+
+    python bench/bench_ui.py --output results.json
+    python bench/bench_ui.py --latency 50 --thresholds budgets.json
+    python bench/bench_ui.py --trace trace.json
+
+``--thresholds`` takes a JSON object of measurement name to p90 milliseconds, which
+overrides the built-in budgets.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Callable
+
+from bench_db import SRC_DIR, git_commit, percentiles
+from fake_server import FakeConfig, FakeServer
+from textual.pilot import WaitForScreenTimeout
+
+sys.path.insert(0, SRC_DIR)
+
+# p90 budgets in milliseconds
+THRESHOLDS = {
+    "group_switch_cold": 1000,
+    "group_switch_warm": 100,
+    "history_1k": 5000,
+    "incoming_message": 100,
+    "incoming_burst_500": 1000,
+    "scroll_top_load": 100,
+    "select_scroll_frame": 50,
+}
+SCREEN_SIZE = (160, 50)
+
+
+async def wait_for(predicate: Callable[[], bool], timeout: float = 30) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.001)
+    return True
+
+
+class UIBench:
+    def __init__(self, server: FakeServer, rounds: int):
+        self.server = server
+        self.rounds = rounds
+        self.samples: dict[str, list[int]] = {name: [] for name in THRESHOLDS}
+        # When the screen was last painted
+        self.painted = 0
+
+    async def run(self, url: str, session: str) -> None:
+        import StealthIM
+        import db
+        from main import IMApp
+        from screens.chat import ChatScreen
+        from screens.widgets import MessageList
+        from textual.widgets import ListView
+
+        db.save_server_to_db("bench", url)
+        server_db = db.get_server_from_db(url)
+        db.save_user_to_db(server_db.id, "user0", session)
+        user_db = db.load_users_from_db(server_db.id)[0]
+
+        app = IMApp()
+        display = app._display
+
+        def paint(screen, renderable) -> None:
+            display(screen, renderable)
+            if renderable is not None:
+                self.painted = time.perf_counter_ns()
+
+        # Headless, the frame is still rendered, only not written out
+        app._display = paint
+        async with app.run_test(size=SCREEN_SIZE) as pilot:
+            app.data.server = StealthIM.Server(url)
+            app.data.server_db = server_db
+            app.data.user = StealthIM.User(app.data.server, user_db.session)
+            app.data.user_db = user_db
+            screen = ChatScreen()
+            await app.push_screen(screen)
+            groups_list = screen.query_one("#groups_list", ListView)
+            await wait_for(lambda: len(groups_list.children) == len(self.server.groups))
+            self.screen = screen
+            self.pilot = pilot
+            self.groups_list = groups_list
+            self.messages = screen.query_one("#messages", MessageList)
+            await self.settle()
+
+            for step in (self.bench_group_switch, self.bench_incoming, self.bench_burst, self.bench_scroll_top,
+                         self.bench_select_scroll, self.bench_history):
+                start = time.perf_counter()
+                await step()
+                print(f"{step.__name__} took {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    async def timed(self, name: str, action: Callable[[], None], done: Callable[[], bool]) -> bool:
+        """Time ``action`` until the last frame painted before everything settled.
+
+        The settling itself (a round trip to every widget, then a moment without work) is left
+        out, it is not something users wait for. Without any frame painted, it counts in full.
+        """
+        start = time.perf_counter_ns()
+        action()
+        ok = await wait_for(done)
+        await self.settle()
+        if ok:
+            end = self.painted if self.painted > start else time.perf_counter_ns()
+            self.samples[name].append(end - start)
+        return ok
+
+    async def settle(self) -> None:
+        """Wait until every widget has processed its messages, the screen is painted then."""
+        while True:
+            try:
+                await self.pilot.pause()
+                return
+            except WaitForScreenTimeout:
+                # Still busy (mounting a long history takes a while)
+                pass
+
+    async def switch_group(self, index: int, name: str) -> None:
+        screen = self.screen
+        group_id = screen.groups[index]
+        worker = screen.message_worker
+
+        def select() -> None:
+            self.groups_list.index = index
+            self.groups_list.action_select_cursor()
+
+        await self.timed(name, select,
+                         lambda: screen.last_group == group_id and screen.message_worker is not worker)
+
+    async def bench_group_switch(self) -> None:
+        count = len(self.screen.groups)
+        # Groups 0 and 1 are kept unvisited for the long history
+        for index in range(2, count):
+            await self.switch_group(index, "group_switch_cold")
+        for _ in range(self.rounds):
+            for index in range(2, count):
+                await self.switch_group(index, "group_switch_warm")
+
+    async def bench_incoming(self) -> None:
+        group = self.server.groups[self.screen.group.group_id]
+        messages = self.messages
+        for i in range(self.rounds * 10):
+            message = None
+
+            def post() -> None:
+                nonlocal message
+                message = self.server.post(group, "user1", f"incoming {i}")
+
+            await self.timed("incoming_message", post,
+                             lambda: messages.rows and messages.rows[-1].msgid == message["msgid"])
+
+    async def bench_burst(self) -> None:
+        group = self.server.groups[self.screen.group.group_id]
+        messages = self.messages
+        for i in range(self.rounds):
+            last = None
+
+            def flood() -> None:
+                nonlocal last
+                for j in range(500):
+                    last = self.server.post(group, "user1", f"burst {i}.{j}")
+
+            await self.timed("incoming_burst_500", flood,
+                             lambda: messages.rows and messages.rows[-1].msgid == last["msgid"])
+
+    async def bench_scroll_top(self) -> None:
+        messages = self.messages
+        for _ in range(self.rounds * 3):
+            messages.scroll_end(animate=False, immediate=True)
+            await self.settle()
+            count = len(messages.rows)
+            if not await self.timed("scroll_top_load", lambda: messages.scroll_home(animate=False, immediate=True),
+                                    lambda: len(messages.rows) > count):
+                break
+
+    async def bench_select_scroll(self) -> None:
+        messages = self.messages
+        await self.screen.action_select_msg()
+        await self.settle()
+        # Whole lines only, the selector updates on integer offsets. Within the newer half, near
+        # the top older messages are loaded, which scroll_top_load measures
+        offsets = [int(messages.max_scroll_y) - (i * 7) % max(1, int(messages.max_scroll_y) // 2)
+                   for i in range(self.rounds * 10)]
+        # Once untimed first, so that the list has pooled the rows it mounts on the way
+        for y in offsets:
+            messages.scroll_to(y=y, animate=False, immediate=True)
+            await self.settle()
+        for y in offsets:
+            await self.timed("select_scroll_frame", lambda: messages.scroll_to(y=y, animate=False, immediate=True),
+                             lambda: True)
+        await self.pilot.press("escape")
+        await self.settle()
+
+    async def bench_history(self) -> None:
+        import db
+        # The server hands out at most 256 messages at once, so the history comes from the database
+        server_id = self.screen.app.data.server_db.id
+        for index in (0, 1):
+            group = self.server.groups[self.screen.groups[index]]
+            with db.engine.begin() as conn:
+                conn.execute(db.Message.__table__.insert(), [{
+                    "server_id": server_id,
+                    "group_id": group.group_id,
+                    "type": message["type"],
+                    "msgid": message["msgid"],
+                    "msg": message["msg"],
+                    "time": datetime.datetime.fromtimestamp(int(message["time"])),
+                    "username": message["username"],
+                    "hash": message["hash"],
+                } for message in group.messages])
+
+        # Switched to like any other group, with pages of 1000 messages from the database
+        screen = self.screen
+        screen.MIN_PAGE = screen.MAX_PAGE = 1000
+        try:
+            for index in (0, 1):
+                await self.switch_group(index, "history_1k")
+        finally:
+            del screen.MIN_PAGE, screen.MAX_PAGE
+
+
+def report(samples: dict[str, list[int]], thresholds: dict[str, float]) -> tuple[dict, bool]:
+    results = {}
+    passed = True
+    print(f"  {'measurement':<24}{'p50':>10}{'p90':>10}{'max':>10}{'budget':>10}  ms")
+    for name, data in samples.items():
+        if not data:
+            print(f"  {name:<24}{'no samples':>30}")
+            continue
+        stat = percentiles(data)
+        budget = thresholds.get(name)
+        ok = budget is None or stat["p90"] <= budget
+        passed &= ok
+        stat["threshold"] = budget
+        stat["passed"] = ok
+        results[name] = stat
+        print(f"  {name:<24}{stat['p50']:>10.1f}{stat['p90']:>10.1f}{stat['max']:>10.1f}"
+              f"{budget if budget is not None else '-':>10}  {'ok' if ok else 'FAIL'}")
+    return results, passed
+
+
+async def bench(args: argparse.Namespace) -> dict:
+    server = FakeServer(FakeConfig(latency=args.latency, jitter=args.jitter, history=args.history, seed=0))
+    sessions = server.seed(users=3, groups=args.groups)
+    url = await server.start()
+    ui = UIBench(server, args.rounds)
+    try:
+        await ui.run(url, sessions["user0"])
+    finally:
+        await server.stop()
+    return ui.samples
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--groups", type=int, default=6, help="at least 4")
+    parser.add_argument("--history", type=int, default=1200, help="messages in every group, at least 1000")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0, help="server latency in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="random +/- latency in ms")
+    parser.add_argument("--thresholds", help="JSON file of p90 budgets in ms, by measurement")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--trace", help="record a Chrome trace of the run into this file")
+    args = parser.parse_args()
+
+    thresholds = dict(THRESHOLDS)
+    if args.thresholds:
+        with open(args.thresholds, encoding="utf-8") as f:
+            thresholds.update(json.load(f))
+    if args.groups < 4:
+        # Two groups for the long history, and warm switches need two more to switch between
+        parser.error("--groups must be at least 4")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["STEALTHIM_DB_PATH"] = os.path.join(tmp, "bench.sqlite")
+        import db
+        from main import setup_tracing
+        from tracing import tracer
+        if args.trace:
+            setup_tracing()
+            tracer.start()
+        samples = asyncio.run(bench(args))
+        if args.trace:
+            tracer.stop()
+            print(f"{tracer.export(args.trace)} spans written to {args.trace}", file=sys.stderr)
+        db.engine.dispose()
+
+    results, passed = report(samples, thresholds)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "commit": git_commit(),
+                "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "latency": args.latency,
+                "results": results,
+                "passed": passed,
+            }, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
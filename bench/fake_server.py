@@ -0,0 +1,565 @@
+"""A local stand-in for the StealthIM server.
+
+Implements the endpoints the client uses, keeps everything in memory and can add
+latency, errors and a flood of incoming messages, so the client can be measured
+without a real server or network:
+
+    python bench/fake_server.py --port 8080 --latency 50 --jitter 20 --error-rate 0.01 --flood-rate 100
+
+It can also run inside another program (see ``FakeServer.start``), which is how the
+benchmarks in this directory use it.
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import os
+import random
+import secrets
+import struct
+import sys
+import time
+from typing import Optional
+
+import blake3
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src"))
+
+import codes  # noqa: E402
+
+BLOCK_SIZE = 2048 * 1024
+END_BLOCK = 0xffffffff
+
+
+@dataclasses.dataclass
+class FakeConfig:
+    # Added to every request except ping, in milliseconds
+    latency: float = 0
+    jitter: float = 0
+    # Fraction of API requests answered with "Server Busy"
+    error_rate: float = 0
+    # Messages per second posted to every group by flood users
+    flood_rate: float = 0
+    # Messages in every seeded group
+    history: int = 0
+    range_support: bool = True
+    seed: Optional[int] = None
+
+
+@dataclasses.dataclass
+class FakeGroup:
+    group_id: int
+    name: str
+    password: str = ""
+    create_at: str = dataclasses.field(default_factory=lambda: str(int(time.time())))
+    # username -> member type (0 member, 1 manager, 2 owner)
+    members: dict[str, int] = dataclasses.field(default_factory=dict)
+    messages: list[dict] = dataclasses.field(default_factory=list)
+    listeners: list[asyncio.Queue] = dataclasses.field(default_factory=list)
+
+
+def result(code: int = codes.SUCCESS, **kwargs) -> web.Response:
+    return web.json_response({"result": {"code": code, "msg": codes.get_msg(code)}, **kwargs})
+
+
+class FakeServer:
+    def __init__(self, config: Optional[FakeConfig] = None):
+        self.config = config or FakeConfig()
+        self.random = random.Random(self.config.seed)
+        self.users: dict[str, dict] = {}
+        self.sessions: dict[str, str] = {}
+        self.groups: dict[int, FakeGroup] = {}
+        self.files: dict[str, bytes] = {}
+        self.next_msgid = 1
+        self.next_group_id = 1
+        # Requests served, by route, for the benchmarks
+        self.requests: dict[str, int] = {}
+        self.runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+        self._flood_task: Optional[asyncio.Task] = None
+        self.app = self._build_app()
+
+    # State helpers, also used by the benchmarks to seed data
+
+    def add_user(self, username: str, password: str = "password", nickname: Optional[str] = None) -> str:
+        """Create a user and return a valid session for it."""
+        self.users[username] = {
+            "username": username,
+            "password": password,
+            "nickname": nickname or username,
+            "email": "",
+            "phone_number": "",
+            "create_time": str(int(time.time())),
+        }
+        return self.new_session(username)
+
+    def new_session(self, username: str) -> str:
+        session = secrets.token_hex(16)
+        self.sessions[session] = username
+        return session
+
+    def add_group(self, name: str, owner: str, members: tuple[str, ...] = ()) -> FakeGroup:
+        group = FakeGroup(self.next_group_id, name)
+        self.next_group_id += 1
+        group.members[owner] = 2
+        for member in members:
+            group.members.setdefault(member, 0)
+        self.groups[group.group_id] = group
+        return group
+
+    def add_file(self, data: bytes) -> str:
+        block_hashes = [blake3.blake3(data[i:i + BLOCK_SIZE]).digest() for i in range(0, len(data), BLOCK_SIZE)]
+        file_hash = blake3.blake3(b"".join(block_hashes)).hexdigest()
+        self.files[file_hash] = data
+        return file_hash
+
+    def post(self, group: FakeGroup, username: str, msg: str, type_: int = 0, hash_: str = "",
+             time_: Optional[int] = None) -> dict:
+        message = {
+            "groupid": group.group_id,
+            "msg": msg,
+            "msgid": self.next_msgid,
+            "time": str(time_ if time_ is not None else int(time.time())),
+            "type": type_,
+            "username": username,
+            "hash": hash_,
+        }
+        self.next_msgid += 1
+        group.messages.append(message)
+        for queue in group.listeners:
+            queue.put_nowait(message)
+        return message
+
+    def seed(self, users: int = 3, groups: int = 3) -> dict[str, str]:
+        """Create some users and groups with ``config.history`` messages each. Returns the sessions."""
+        sessions = {f"user{i}": self.add_user(f"user{i}", nickname=f"User {i}") for i in range(users)}
+        names = list(sessions)
+        now = int(time.time())
+        for i in range(groups):
+            group = self.add_group(f"Group {i}", names[0], tuple(names[1:]))
+            for j in range(self.config.history):
+                self.post(group, self.random.choice(names), f"message {j} in group {i}",
+                          time_=now - (self.config.history - j) * 60)
+        return sessions
+
+    # Server lifecycle
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        if self.config.flood_rate > 0:
+            self._flood_task = asyncio.create_task(self._flood())
+        return self.url
+
+    async def stop(self) -> None:
+        if self._flood_task:
+            self._flood_task.cancel()
+        for group in self.groups.values():
+            for queue in group.listeners:
+                queue.put_nowait(None)
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def _flood(self) -> None:
+        flooder = "flooder"
+        if flooder not in self.users:
+            self.add_user(flooder, nickname="Flooder")
+        interval = 1 / self.config.flood_rate
+        count = 0
+        while True:
+            await asyncio.sleep(interval)
+            for group in list(self.groups.values()):
+                group.members.setdefault(flooder, 0)
+                self.post(group, flooder, f"flood {count}")
+            count += 1
+
+    # Middlewares
+
+    def _build_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware], client_max_size=BLOCK_SIZE * 2)
+        r = app.router
+        r.add_get("/api/v1/ping", self.ping)
+        r.add_post("/api/v1/user/register", self.register)
+        r.add_post("/api/v1/user", self.login)
+        r.add_get("/api/v1/user", self.self_info)
+        r.add_patch("/api/v1/user/{field}", self.change_user)
+        r.add_get("/api/v1/user/{username}", self.user_info)
+        r.add_get("/api/v1/group/", self.get_groups)
+        r.add_post("/api/v1/group", self.create_group)
+        r.add_get("/api/v1/group/{groupid}", self.group_info)
+        r.add_get("/api/v1/group/{groupid}/public", self.group_public_info)
+        r.add_post("/api/v1/group/{groupid}/join", self.join_group)
+        r.add_post("/api/v1/group/{groupid}/invite", self.invite)
+        r.add_patch("/api/v1/group/{groupid}/name", self.change_group_name)
+        r.add_patch("/api/v1/group/{groupid}/password", self.change_group_password)
+        r.add_put("/api/v1/group/{groupid}/{username}", self.set_role)
+        r.add_delete("/api/v1/group/{groupid}/{username}", self.kick)
+        r.add_get("/api/v1/message/{groupid}", self.get_messages)
+        r.add_post("/api/v1/message/{groupid}", self.send_message)
+        r.add_patch("/api/v1/message/{groupid}", self.recall_message)
+        r.add_get("/api/v1/file/", self.upload_file)
+        r.add_post("/api/v1/file/{hash}", self.file_info)
+        r.add_get("/api/v1/file/{hash}", self.download_file)
+        return app
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else "?"
+        key = f"{request.method} {route}"
+        self.requests[key] = self.requests.get(key, 0) + 1
+        if handler == self.ping:
+            return await handler(request)
+        if self.config.latency or self.config.jitter:
+            delay = self.config.latency + self.random.uniform(-self.config.jitter, self.config.jitter)
+            await asyncio.sleep(max(delay, 0) / 1000)
+        if self.config.error_rate and self.random.random() < self.config.error_rate:
+            if handler in (self.get_messages, self.download_file, self.upload_file):
+                raise web.HTTPServiceUnavailable()
+            return result(904)
+        return await handler(request)
+
+    def _user(self, request: web.Request) -> Optional[str]:
+        auth = request.headers.get("Authorization", "")
+        return self.sessions.get(auth.removeprefix("Bearer "))
+
+    def _group(self, request: web.Request, username: str) -> tuple[Optional[FakeGroup], int]:
+        group = self.groups.get(int(request.match_info["groupid"]))
+        if group is None or username not in group.members:
+            return None, codes.GROUP_USER_NOT_FOUND
+        return group, codes.SUCCESS
+
+    # Users
+
+    async def ping(self, _request: web.Request) -> web.Response:
+        return web.json_response({"message": "Hello, StealthIM!"})
+
+    async def register(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if body["username"] in self.users:
+            return result(codes.USER_ALREADY_EXISTS)
+        self.add_user(body["username"], body["password"], body.get("nickname"))
+        return result()
+
+    async def login(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        user = self.users.get(body["username"])
+        if user is None:
+            return result(codes.USER_NOT_FOUND)
+        if user["password"] != body["password"]:
+            return result(codes.USER_WRONG_PASSWORD)
+        info = {k: v for k, v in user.items() if k != "password"}
+        return result(session=self.new_session(user["username"]), user_info=info)
+
+    async def self_info(self, request: web.Request) -> web.Response:
+        if not (username := self._user(request)):
+            return result(codes.AUTHENTICATION_FAILED)
+        info = {k: v for k, v in self.users[username].items() if k != "password"}
+        return result(user_info=info)
+
+    async def user_info(self, request: web.Request) -> web.Response:
+        if not self._user(request):
+            return result(codes.AUTHENTICATION_FAILED)
+        user = self.users.get(request.match_info["username"])
+        if user is None:
+            return result(codes.USER_NOT_FOUND)
+        return result(user_info={"nickname": user["nickname"]})
+
+    async def change_user(self, request: web.Request) -> web.Response:
+        if not (username := self._user(request)):
+            return result(codes.AUTHENTICATION_FAILED)
+        body = await request.json()
+        field = {"phone": "phone_number"}.get(request.match_info["field"], request.match_info["field"])
+        if field in self.users[username]:
+            self.users[username][field] = next(iter(body.values()))
+        return result()
+
+    # Groups
+
+    async def get_groups(self, request: web.Request) -> web.Response:
+        if not (username := self._user(request)):
+            return result(codes.AUTHENTICATION_FAILED)
+        return result(groups=[g.group_id for g in self.groups.values() if username in g.members])
+
+    async def create_group(self, request: web.Request) -> web.Response:
+        if not (username := self._user(request)):
+            return result(codes.AUTHENTICATION_FAILED)
+        body = await request.json()
+        return result(groupid=self.add_group(body["name"], username).group_id)
+
+    async def group_info(self, request: web.Request) -> web.Response:
+        if not (username := self._user(request)):
+            return result(codes.AUTHENTICATION_FAILED)
+        group, code = self._group(request, username)
+        if not group:
+            return result(code)
+        return result(members=[{"name": name, "type": type_} for name, type_ in group.members.items()])
+
+    async def group_public_info(self, request: web.Request) -> web.Response:
+        if not self._user(request):
+            return result(codes.AUTHENTICATION_FAILED)
+        group = self.groups.get(int(request.match_info["groupid"]))
+        if group is None:
+            return result(codes.GROUP_USER_NOT_FOUND)
+        return result(name=group.name, create_at=group.create_at)
+
+    async def join_group(self, request: web.Request) -> web.Response:
+        if not (username := self._user(request)):
+            return result(codes.AUTHENTICATION_FAILED)
+        group = self.groups.get(int(request.match_info["groupid"]))
+        body = await request.json()
+        if group is None:
+            return result(codes.GROUP_USER_NOT_FOUND)
+        if username in group.members:
+            return result(codes.GROUP_USER_ALREADY_IN_GROUP)
+        if body.get("password", "") != group.password:
+            return result(codes.GROUP_USER_PASSWORD_INCORRECT)
+        group.members[username] = 0
+        return result()
+
+    async def invite(self, request: web.Request) -> web.Response:
+        if not (username := self._user(request)):
+            return result(codes.AUTHENTICATION_FAILED)
+        group, code = self._group(request, username)
+        body = await request.json()
+        if not group:
+            return result(code)
+        if body["username"] not in self.users:
+            return result(codes.USER_NOT_FOUND)
+        group.members.setdefault(body["username"], 0)
+        return result()
+
+    async def change_group_name(self, request: web.Request) -> web.Response:
+        if not (username := self._user(request)):
+            return result(codes.AUTHENTICATION_FAILED)
+        group, code = self._group(request, username)
+        if not group:
+            return result(code)
+        group.name = (await request.json())["name"]
+        return result()
+
+    async def change_group_password(self, request: web.Request) -> web.Response:
+        if not (username := self._user(request)):
+            return result(codes.AUTHENTICATION_FAILED)
+        group, code = self._group(request, username)
+        if not group:
+            return result(code)
+        group.password = (await request.json())["password"]
+        return result()
+
+    async def set_role(self, request: web.Request) -> web.Response:
+        if not (username := self._user(request)):
+            return result(codes.AUTHENTICATION_FAILED)
+        group, code = self._group(request, username)
+        if not group:
+            return result(code)
+        if request.match_info["username"] not in group.members:
+            return result(codes.USER_NOT_FOUND)
+        group.members[request.match_info["username"]] = (await request.json())["type"]
+        return result()
+
+    async def kick(self, request: web.Request) -> web.Response:
+        if not (username := self._user(request)):
+            return result(codes.AUTHENTICATION_FAILED)
+        group, code = self._group(request, username)
+        if not group:
+            return result(code)
+        if group.members.pop(request.match_info["username"], None) is None:
+            return result(codes.USER_NOT_FOUND)
+        return result()
+
+    # Messages
+
+    async def get_messages(self, request: web.Request) -> web.StreamResponse:
+        if not (username := self._user(request)):
+            raise web.HTTPUnauthorized()
+        group, _ = self._group(request, username)
+        if not group:
+            raise web.HTTPNotFound()
+        from_id = int(request.query.get("msgid", "0"))
+        sync = request.query.get("sync", "true") == "true"
+        limit = int(request.query.get("limit", "128"))
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(messages: list[dict]) -> None:
+            data = json.dumps({"result": {"code": codes.SUCCESS, "msg": ""}, "msg": messages})
+            await response.write(f"data: {data}\n\n".encode("utf-8"))
+
+        if not sync:
+            # History, newest first: the latest messages, or the ones before from_id
+            older = [m for m in group.messages if from_id == 0 or m["msgid"] < from_id]
+            await send(older[-limit:][::-1] if limit else [])
+            return response
+
+        queue: asyncio.Queue = asyncio.Queue()
+        group.listeners.append(queue)
+        try:
+            if from_id >= 0:
+                newer = [m for m in group.messages if m["msgid"] > from_id]
+                for i in range(0, len(newer), max(limit, 1)):
+                    await send(newer[i:i + max(limit, 1)])
+            while True:
+                message = await queue.get()
+                if message is None:
+                    break
+                batch = [message]
+                # Send what piled up in one event, like the real server does under load
+                while not queue.empty() and len(batch) < max(limit, 1):
+                    if (message := queue.get_nowait()) is None:
+                        break
+                    batch.append(message)
+                await send(batch)
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            group.listeners.remove(queue)
+        return response
+
+    async def send_message(self, request: web.Request) -> web.Response:
+        if not (username := self._user(request)):
+            return result(codes.AUTHENTICATION_FAILED)
+        group, code = self._group(request, username)
+        if not group:
+            return result(code)
+        body = await request.json()
+        if not body.get("msg"):
+            return result(1003)
+        if len(body["msg"]) > 4096:
+            return result(codes.MESSAGE_CONTENT_TOO_LONG)
+        self.post(group, username, body["msg"], body.get("type", 0))
+        return result()
+
+    async def recall_message(self, request: web.Request) -> web.Response:
+        if not (username := self._user(request)):
+            return result(codes.AUTHENTICATION_FAILED)
+        group, code = self._group(request, username)
+        if not group:
+            return result(code)
+        msgid = (await request.json())["msgid"]
+        message = next((m for m in group.messages if m["msgid"] == msgid), None)
+        if message is None:
+            return result(codes.MESSAGE_MESSAGE_NOT_FOUND)
+        if message["username"] != username and group.members[username] == 0:
+            return result(codes.MESSAGE_PERMISSION_DENIED)
+        message["type"] = 16
+        message["msg"] = ""
+        for queue in group.listeners:
+            queue.put_nowait(dict(message))
+        return result()
+
+    # Files
+
+    async def file_info(self, request: web.Request) -> web.Response:
+        if not self._user(request):
+            return result(codes.AUTHENTICATION_FAILED)
+        data = self.files.get(request.match_info["hash"])
+        if data is None:
+            return result(codes.FILE_FILE_NOT_FOUND)
+        return result(size=len(data))
+
+    async def download_file(self, request: web.Request) -> web.StreamResponse:
+        if not self._user(request):
+            raise web.HTTPUnauthorized()
+        data = self.files.get(request.match_info["hash"])
+        if data is None:
+            raise web.HTTPNotFound()
+        start, end = 0, len(data) - 1
+        range_header = request.headers.get("Range")
+        if range_header and self.config.range_support:
+            first, last = range_header.removeprefix("bytes=").split("-")
+            start, end = int(first), int(last or end)
+
+        response = web.StreamResponse(headers={"Content-Type": "application/octet-stream"})
+        await response.prepare(request)
+        for block_id in range(start // BLOCK_SIZE, end // BLOCK_SIZE + 1):
+            block = data[block_id * BLOCK_SIZE:(block_id + 1) * BLOCK_SIZE]
+            await response.write(struct.pack("<II", block_id, len(block)) + block)
+        await response.write(struct.pack("<II", END_BLOCK, 0))
+        return response
+
+    async def upload_file(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=BLOCK_SIZE * 2)
+        await ws.prepare(request)
+        username = self._user(request)
+
+        async def reply(code: int) -> None:
+            await ws.send_str(json.dumps({"result": {"code": code, "msg": codes.get_msg(code)}}))
+
+        meta = json.loads((await ws.receive()).data)
+        group = self.groups.get(int(meta["groupid"]))
+        if not username:
+            await reply(codes.AUTHENTICATION_FAILED)
+        elif group is None or username not in group.members:
+            await reply(codes.GROUP_USER_NOT_FOUND)
+        elif meta["hash"] in self.files:
+            await reply(codes.FILE_REPEATED_FILE)
+            self.post(group, username, meta["filename"], 4, meta["hash"])
+        else:
+            await reply(0)
+            size = int(meta["size"])
+            blocks: dict[int, bytes] = {}
+            for _ in range((size + BLOCK_SIZE - 1) // BLOCK_SIZE):
+                msg = await ws.receive()
+                block_id, = struct.unpack("<I", msg.data[:4])
+                blocks[block_id] = msg.data[4:]
+                await reply(0)
+            data = b"".join(blocks[i] for i in sorted(blocks))
+            if self.add_file(data) != meta["hash"]:
+                self.files.pop(meta["hash"], None)
+                await reply(codes.FILE_HASH_NOT_MATCH)
+            else:
+                self.post(group, username, meta["filename"], 4, meta["hash"])
+                await reply(codes.SUCCESS)
+        await ws.close()
+        return ws
+
+
+async def serve(args: argparse.Namespace) -> None:
+    server = FakeServer(FakeConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        flood_rate=args.flood_rate,
+        history=args.history,
+        range_support=not args.no_range,
+        seed=args.seed,
+    ))
+    sessions = server.seed(args.users, args.groups)
+    url = await server.start(args.host, args.port)
+    print(f"Fake StealthIM server on {url}")
+    print("Users (password: password):")
+    for username, session in sessions.items():
+        print(f"  {username}  session={session}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0, help="added latency in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="random +/- latency in ms")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests that fail")
+    parser.add_argument("--flood-rate", type=float, default=0, help="messages per second in every group")
+    parser.add_argument("--users", type=int, default=3)
+    parser.add_argument("--groups", type=int, default=3)
+    parser.add_argument("--history", type=int, default=100, help="messages in every group")
+    parser.add_argument("--no-range", action="store_true", help="ignore Range on file downloads")
+    parser.add_argument("--seed", type=int, default=None)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import os
+import shutil
+import sys
+from typing import Optional
+
+import db
+from log import logger
+
+BLOB_DIR = os.path.join(os.path.dirname(db.DB_PATH), "blobs")
+
+# ioctl number of FICLONE on Linux, clones the extents of a file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def reflink(src: str, dst: str) -> bool:
+    if sys.platform != "linux":
+        return False
+    import fcntl
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+
+class BlobStore:
+    """Local copies of downloaded files, stored once per file hash.
+
+    A file that was downloaded before, in any group, is materialized from the store
+    (reflink, then hardlink, then copy) without touching the network. The store is
+    bounded by MAX_SIZE and evicts the least recently used blobs.
+    """
+    MAX_SIZE = 1024 ** 3
+
+    def __init__(self, path: str = BLOB_DIR, max_size: Optional[int] = None):
+        self.path = path
+        self.max_size = max_size if max_size is not None else self.MAX_SIZE
+        os.makedirs(self.path, exist_ok=True)
+
+    def blob_path(self, file_hash: str) -> str:
+        return os.path.join(self.path, file_hash[:2], file_hash)
+
+    def part_path(self, file_hash: str) -> str:
+        return self.blob_path(file_hash) + ".part"
+
+    def has(self, file_hash: str) -> bool:
+        blob = db.get_blob(file_hash)
+        if not blob:
+            return False
+        try:
+            stat = os.stat(self.blob_path(file_hash))
+        except OSError:
+            stat = None
+        # Gone, or changed through a hardlink: it is not the content of the hash any more
+        if not stat or stat.st_size != blob.size or stat.st_mtime_ns != blob.mtime:
+            self.remove(file_hash)
+            return False
+        return True
+
+    def add(self, file_hash: str, src: str) -> str:
+        """Move a verified file into the store."""
+        path = self.blob_path(file_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src, path)
+        stat = os.stat(path)
+        db.add_blob(file_hash, stat.st_size, stat.st_mtime_ns)
+        self.evict(keep=file_hash)
+        return path
+
+    def is_materialized(self, file_hash: str, path: str) -> bool:
+        """Whether ``path`` is a hardlink of the blob, so there is nothing to download."""
+        try:
+            return self.has(file_hash) and os.path.samefile(path, self.blob_path(file_hash))
+        except OSError:
+            return False
+
+    def materialize(self, file_hash: str, dst: str) -> None:
+        src = self.blob_path(file_hash)
+        db.touch_blob(file_hash)
+        if reflink(src, dst):
+            return
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+        shutil.copyfile(src, dst)
+
+    def remove(self, file_hash: str) -> None:
+        path = self.blob_path(file_hash)
+        if os.path.exists(path):
+            os.remove(path)
+        db.delete_blob(file_hash)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        total = db.get_blobs_size()
+        while total > self.max_size:
+            oldest = [blob for blob in db.get_oldest_blobs() if blob.hash != keep]
+            if not oldest:
+                break
+            for blob in oldest:
+                logger.debug(f"Evicting blob {blob.hash}")
+                self.remove(blob.hash)
+                total -= blob.size
+                if total <= self.max_size:
+                    break
@@ -60,6 +60,11 @@ def get_msg(code: int) -> str:
 
 SUCCESS = 800
 
+MESSAGE_EMPTY_UID = 1001
+MESSAGE_EMPTY_GROUP_ID = 1002
+MESSAGE_EMPTY_CONTENT = 1003
+MESSAGE_UNKNOWN_TYPE = 1004
+MESSAGE_EMPTY_MESSAGE_ID = 1005
 MESSAGE_CONTENT_TOO_LONG = 1006
 MESSAGE_MESSAGE_NOT_FOUND = 1007
 MESSAGE_PERMISSION_DENIED = 1008
@@ -1,15 +1,18 @@
+import collections
 import datetime
 import os
-from typing import cast, Optional
+from typing import cast, Optional, Sequence
 
-from sqlalchemy import Column, Integer, String, create_engine, DateTime, Text, func
+from sqlalchemy import Column, Index, Integer, Row, String, create_engine, DateTime, Text, func, select
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 import StealthIM
 import codes
 from StealthIM.apis.message import MessageType
 
-DB_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../data/configs.sqlite"))
+# STEALTHIM_DB_PATH points the client (or a benchmark) at another database file
+DB_PATH = os.path.abspath(os.environ.get("STEALTHIM_DB_PATH")
+                          or os.path.join(os.path.dirname(__file__), "../data/configs.sqlite"))
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
 Base = declarative_base()
@@ -18,6 +21,11 @@ SessionLocal = sessionmaker(bind=engine)
 
 MAX_MSGID = 2 ** 63 - 1
 
+# Hits and misses of the nickname, group name and file size caches, e.g. "nickname.hit"
+cache_stats: collections.Counter[str] = collections.Counter()
+# Messages saved since start, for the ingest rate of the performance panel
+saved_messages = 0
+
 
 class Server(Base):
     __tablename__ = "servers"
@@ -26,6 +34,13 @@ class Server(Base):
     url = Column(String, nullable=False)
 
 
+class ServerEndpoint(Base):
+    __tablename__ = "server_endpoints"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    server_id = Column(Integer, nullable=False)
+    url = Column(String, nullable=False)
+
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -55,6 +70,16 @@ class Message(Base):
     username = Column(String, nullable=False)
     hash = Column(String, nullable=False)
 
+    __table_args__ = (
+        Index("ix_messages_msgid", "server_id", "group_id", "msgid"),
+        Index("ix_messages_time", "server_id", "group_id", "time"),
+    )
+
+
+# What a message row needs to be shown, get_messages reads these
+MESSAGE_COLUMNS = (Message.server_id, Message.group_id, Message.type, Message.msgid, Message.msg,
+                   Message.time, Message.username, Message.hash)
+
 
 class Nickname(Base):
     __tablename__ = "nicknames"
@@ -74,7 +99,30 @@ class FileHash(Base):
     size = Column(Integer, nullable=False)
 
 
+class Blob(Base):
+    __tablename__ = "blobs"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    hash = Column(String, nullable=False, unique=True)
+    size = Column(Integer, nullable=False)
+    mtime = Column(Integer, nullable=False)
+    last_access = Column(DateTime, nullable=False)
+
+
+class OutboxMessage(Base):
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    server_id = Column(Integer, nullable=False)
+    group_id = Column(Integer, nullable=False)
+    username = Column(String, nullable=False)
+    msg = Column(Text, nullable=False)
+    time = Column(DateTime, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+
+
 Base.metadata.create_all(bind=engine)
+# create_all skips the tables which exist, their new indexes are added here
+for index in Message.__table__.indexes:
+    index.create(bind=engine, checkfirst=True)
 
 
 def load_servers_from_db() -> list[Server]:
@@ -84,21 +132,39 @@ def load_servers_from_db() -> list[Server]:
 
 def get_server_from_db(url: str) -> Optional[Server]:
     with SessionLocal() as session:
-        return session.query(Server).filter_by(url=url).first()
+        server = session.query(Server).filter_by(url=url).first()
+        if server:
+            return server
+        # One of the other endpoints
+        endpoint = session.query(ServerEndpoint).filter_by(url=url).first()
+        if endpoint:
+            return session.query(Server).filter_by(id=endpoint.server_id).first()
+        return None
 
 
-def save_server_to_db(name: str, url: str) -> None:
+def save_server_to_db(name: str, url: str, extra_urls: Sequence[str] = ()) -> None:
     with SessionLocal() as session:
         server = Server(name=name, url=url)
         session.add(server)
+        session.flush()
+        for extra_url in extra_urls:
+            session.add(ServerEndpoint(server_id=server.id, url=extra_url))
         session.commit()
 
 
+def get_server_endpoints(server: Server) -> list[str]:
+    """All the URLs of a server, the main one first."""
+    with SessionLocal() as session:
+        endpoints = session.query(ServerEndpoint).filter_by(server_id=server.id).order_by(ServerEndpoint.id.asc())
+        return [cast(str, server.url)] + [cast(str, endpoint.url) for endpoint in endpoints]
+
+
 def delete_server_from_db(server_id: int) -> None:
     with SessionLocal() as session:
         server = session.query(Server).filter_by(id=server_id).first()
         if server:
             session.delete(server)
+            session.query(ServerEndpoint).filter_by(server_id=server_id).delete()
             session.commit()
 
 
@@ -171,6 +237,7 @@ async def get_group_name(server_id: int, user: StealthIM.User, group_id: int, fo
         group = session.query(Group).filter_by(group_id=group_id, server_id=server_id).first()
     if not group or datetime.datetime.now(datetime.timezone.utc) - group.last_update.replace(
             tzinfo=datetime.timezone.utc) > datetime.timedelta(days=1) or force_flush:
+        cache_stats["group_name.miss"] += 1
         res = await StealthIM.Group(user, group_id).get_info()
         if res.result.code == codes.SUCCESS:
             if group:
@@ -178,6 +245,7 @@ async def get_group_name(server_id: int, user: StealthIM.User, group_id: int, fo
             else:
                 add_group(server_id, group_id, res.name)
         return res
+    cache_stats["group_name.hit"] += 1
     return StealthIM.group.GroupPublicInfoResult(
         result=StealthIM.apis.common.Result(
             code=codes.SUCCESS,
@@ -210,6 +278,7 @@ async def get_nickname(server_id: int, user: StealthIM.User, username: str) -> S
         col = session.query(Nickname).filter_by(server_id=server_id, username=username).first()
     if not col or datetime.datetime.now(datetime.timezone.utc) - col.last_update.replace(
             tzinfo=datetime.timezone.utc) > datetime.timedelta(days=1):
+        cache_stats["nickname.miss"] += 1
         res = await user.get_user_info(username)
         if res.result.code == codes.SUCCESS:
             if col:
@@ -217,6 +286,7 @@ async def get_nickname(server_id: int, user: StealthIM.User, username: str) -> S
             else:
                 add_nickname(server_id, username, res.nickname)
         return res
+    cache_stats["nickname.hit"] += 1
     return StealthIM.group.StealthIM.user.UserPublicInfo(
         result=StealthIM.apis.common.Result(
             code=codes.SUCCESS,
@@ -236,6 +306,8 @@ def add_message(
         msgid: int,
         hash_: str = ""
 ):
+    global saved_messages
+    saved_messages += 1
     with SessionLocal() as session:
         msg = Message(
             server_id=server_id,
@@ -253,6 +325,25 @@ def add_message(
         return msg
 
 
+def add_messages(server_id: int, group_id: int, messages: list[tuple]) -> list[Message]:
+    """Add many messages in one transaction.
+
+    ``messages`` are ``(type_, msg, time, username, msgid, hash_)`` tuples, returned as
+    Message rows in the same order.
+    """
+    global saved_messages
+    saved_messages += len(messages)
+    with SessionLocal(expire_on_commit=False) as session:
+        rows = [
+            Message(server_id=server_id, group_id=group_id, type=type_, msg=msg, time=time,
+                    username=username, msgid=msgid, hash=hash_)
+            for type_, msg, time, username, msgid, hash_ in messages
+        ]
+        session.add_all(rows)
+        session.commit()
+        return rows
+
+
 def recall_message(
         server_id: int,
         group_id: int,
@@ -262,17 +353,29 @@ def recall_message(
         msg = session.query(Message).filter_by(server_id=server_id, group_id=group_id, msgid=msgid).first()
         if not msg:
             return
-        msg.type = MessageType.Recall
+        msg.type = MessageType.Recall.value
         msg.msg = ""
         session.add(msg)
         session.commit()
 
 
+def recall_messages(server_id: int, group_id: int, msgids: list[int]) -> int:
+    """Mark many messages as recalled in one transaction, returns how many were found."""
+    with SessionLocal() as session:
+        count = session.query(Message).filter(
+            Message.server_id == server_id,
+            Message.group_id == group_id,
+            Message.msgid.in_(msgids),
+        ).update({Message.type: MessageType.Recall.value, Message.msg: ""}, synchronize_session=False)
+        session.commit()
+        return count
+
+
 def get_latest_messages(
         server_id: int,
         group_id: int,
         limit: int = 100
-) -> list[Message]:
+) -> list[Row]:
     with SessionLocal() as session:
         max_id = session.query(func.max(Message.msgid)).filter_by(
             server_id=server_id, group_id=group_id
@@ -280,44 +383,69 @@ def get_latest_messages(
     return get_messages(server_id, group_id, max_id + 1, False, limit)
 
 
+def get_message(server_id: int, group_id: int, msgid: int) -> Optional[Message]:
+    with SessionLocal() as session:
+        return session.query(Message).filter_by(server_id=server_id, group_id=group_id, msgid=msgid).first()
+
+
+def get_message_by_time(
+        server_id: int,
+        group_id: int,
+        time: datetime.datetime,
+        after: bool = True
+) -> Optional[Message]:
+    """The first message at or after ``time``, or with ``after=False`` the last one before it."""
+    with SessionLocal() as session:
+        query = session.query(Message).filter(Message.server_id == server_id, Message.group_id == group_id)
+        if after:
+            query = query.filter(Message.time >= time).order_by(Message.time.asc(), Message.msgid.asc())
+        else:
+            query = query.filter(Message.time < time).order_by(Message.time.desc(), Message.msgid.desc())
+        return query.first()
+
+
+def get_msgids(server_id: int, group_id: int, low: int, high: int) -> set[int]:
+    """The msgids stored between ``low`` and ``high``, both included."""
+    with SessionLocal() as session:
+        rows = session.query(Message.msgid).filter(
+            Message.server_id == server_id,
+            Message.group_id == group_id,
+            Message.msgid.between(low, high)
+        ).all()
+        return {row[0] for row in rows}
+
+
 def get_messages(
         server_id: int,
         group_id: int,
         from_: int,
         old_to_new: bool = True,
         limit: int = 100
-) -> list[Message]:
-    with SessionLocal() as session:
-        if old_to_new:
-            # 从 from_ 往新的方向
-            base_query = (
-                session.query(Message)
-                .filter(
-                    Message.server_id == server_id,
-                    Message.group_id == group_id,
-                    Message.msgid > from_
-                )
-                .order_by(Message.msgid.asc())
-            )
-        else:
-            # 从 from_ 往旧的方向
-            base_query = (
-                session.query(Message)
-                .filter(
-                    Message.server_id == server_id,
-                    Message.group_id == group_id,
-                    Message.msgid < from_
-                )
-                .order_by(Message.msgid.desc())
-            )
-
-        subquery = base_query.limit(limit).subquery()
-
-        return cast(list[Message],
-                    session.query(Message)
-                    .from_statement(subquery.select().order_by(subquery.c.msgid.asc()))
-                    .all()
-                    )
+) -> list[Row]:
+    """Up to ``limit`` messages after ``from_`` (or before it), oldest first.
+
+    Plain rows with the columns of MESSAGE_COLUMNS, read like Message entities but
+    without the ORM tracking them.
+    """
+    if old_to_new:
+        # 从 from_ 往新的方向
+        query = select(*MESSAGE_COLUMNS).where(
+            Message.server_id == server_id,
+            Message.group_id == group_id,
+            Message.msgid > from_
+        ).order_by(Message.msgid.asc()).limit(limit)
+        with engine.connect() as conn:
+            return list(conn.execute(query))
+    # 从 from_ 往旧的方向
+    query = select(*MESSAGE_COLUMNS).where(
+        Message.server_id == server_id,
+        Message.group_id == group_id,
+        Message.msgid < from_
+    ).order_by(Message.msgid.desc()).limit(limit)
+    with engine.connect() as conn:
+        rows = list(conn.execute(query))
+    rows.reverse()
+    return rows
 
 
 def add_file_size(server_id: int, group_id: int, hash_: str, size: int) -> None:
@@ -338,11 +466,94 @@ async def get_file_size(group: StealthIM.Group, hash_str: str) -> int:
     with SessionLocal() as session:
         res = session.query(FileHash).filter_by(server_id=server_id, group_id=group.group_id, hash=hash_str).first()
         if res:
+            cache_stats["file_size.hit"] += 1
             return cast(int, res.size)
 
+        cache_stats["file_size.miss"] += 1
         size_res = await group.get_file_info(hash_str)
         if size_res.result.code == codes.SUCCESS:
             add_file_size(server_id, group.group_id, hash_str, size_res.size)
             return size_res.size
         return 0
 
+
+def add_outbox_message(server_id: int, group_id: int, username: str, msg: str) -> OutboxMessage:
+    with SessionLocal() as session:
+        item = OutboxMessage(
+            server_id=server_id,
+            group_id=group_id,
+            username=username,
+            msg=msg,
+            time=datetime.datetime.now(),
+            attempts=0
+        )
+        session.add(item)
+        session.commit()
+        return session.query(OutboxMessage).filter_by(id=item.id).first()
+
+
+def get_outbox_messages(server_id: int, group_id: Optional[int] = None) -> list[OutboxMessage]:
+    with SessionLocal() as session:
+        query = session.query(OutboxMessage).filter_by(server_id=server_id)
+        if group_id is not None:
+            query = query.filter_by(group_id=group_id)
+        return cast(list[OutboxMessage], query.order_by(OutboxMessage.id.asc()).all())
+
+
+def update_outbox_attempts(outbox_id: int, attempts: int) -> None:
+    with SessionLocal() as session:
+        item = session.query(OutboxMessage).filter_by(id=outbox_id).first()
+        if item:
+            item.attempts = attempts
+            session.commit()
+
+
+def delete_outbox_message(outbox_id: int) -> None:
+    with SessionLocal() as session:
+        item = session.query(OutboxMessage).filter_by(id=outbox_id).first()
+        if item:
+            session.delete(item)
+            session.commit()
+
+
+def get_blob(hash_: str) -> Optional[Blob]:
+    with SessionLocal() as session:
+        return session.query(Blob).filter_by(hash=hash_).first()
+
+
+def add_blob(hash_: str, size: int, mtime: int) -> None:
+    with SessionLocal() as session:
+        blob = session.query(Blob).filter_by(hash=hash_).first()
+        if not blob:
+            blob = Blob(hash=hash_)
+            session.add(blob)
+        blob.size = size
+        blob.mtime = mtime
+        blob.last_access = datetime.datetime.now(datetime.timezone.utc)
+        session.commit()
+
+
+def touch_blob(hash_: str) -> None:
+    with SessionLocal() as session:
+        blob = session.query(Blob).filter_by(hash=hash_).first()
+        if blob:
+            blob.last_access = datetime.datetime.now(datetime.timezone.utc)
+            session.commit()
+
+
+def delete_blob(hash_: str) -> None:
+    with SessionLocal() as session:
+        blob = session.query(Blob).filter_by(hash=hash_).first()
+        if blob:
+            session.delete(blob)
+            session.commit()
+
+
+def get_blobs_size() -> int:
+    with SessionLocal() as session:
+        return session.query(func.sum(Blob.size)).scalar() or 0
+
+
+def get_oldest_blobs(limit: int = 16) -> list[Blob]:
+    with SessionLocal() as session:
+        return cast(list[Blob], session.query(Blob).order_by(Blob.last_access.asc()).limit(limit).all())
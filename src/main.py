@@ -1,5 +1,9 @@
 import dataclasses
+import datetime
+import gc
 import logging
+import os
+import time
 from typing import Optional
 
 from textual.app import App
@@ -10,6 +14,8 @@ import db
 import screens
 from log import logger
 from patch import Screen, ModalScreen
+from screens.chat import ChatScreen
+from tracing import tracer
 
 
 def get_screens(module):
@@ -33,6 +39,15 @@ class AppData:
     user: Optional[StealthIM.User] = None
     user_db: Optional[db.User] = None
     group: Optional[StealthIM.Group] = None
+    # Result and time.monotonic() of the last session check, by user id
+    session_checks: dict[int, tuple[bool, float]] = dataclasses.field(default_factory=dict)
+
+
+# Seconds without painting the screen after which a full garbage collection may run
+GC_IDLE = 1
+# Collections of the middle generation a full one waits for, painting or not. Python's own is
+# 10, a full collection walks every object the app keeps, longer than a frame with a long history
+GC_FULL_AFTER = 100
 
 
 class IMApp(App):
@@ -43,19 +58,61 @@ class IMApp(App):
     SCREENS = {
         screen.SCREEN_NAME: screen for screen in ALL_SCREENS
     }
-    BINDINGS = [("ctrl+b", "app_back", "Back")]
+    BINDINGS = [("ctrl+b", "app_back", "Back"), ("ctrl+t", "toggle_trace", "Trace"), ("f12", "toggle_perf", "Perf")]
 
     def __init__(self):
         super().__init__()
         self.data = AppData()
+        self.painted_at = time.monotonic()
+        setup_tracing()
 
     async def on_mount(self) -> None:
+        # Modules, classes and styles are never freed, no collection needs to walk them again
+        gc.freeze()
+        gen0, gen1, _ = gc.get_threshold()
+        gc.set_threshold(gen0, gen1, GC_FULL_AFTER)
+        self.set_interval(GC_IDLE, self.collect_when_idle)
         await self.push_screen(screens.ServerSelectScreen.SCREEN_NAME)
 
+    def post_display_hook(self) -> None:
+        self.painted_at = time.monotonic()
+
+    def collect_when_idle(self) -> None:
+        """The full collections Python would have run by now, while nothing is shown."""
+        if gc.get_count()[2] >= 10 and time.monotonic() - self.painted_at >= GC_IDLE:
+            gc.collect()
+
     async def action_app_back(self):
         if len(self.screen_stack) > 2:
             await self.pop_screen()
 
+    async def action_toggle_perf(self):
+        if isinstance(self.screen, screens.PerfScreen):
+            await self.pop_screen()
+        else:
+            await self.push_screen(screens.PerfScreen.SCREEN_NAME)
+
+    # Start tracing, or stop it and write the trace
+    def action_toggle_trace(self):
+        if not tracer.enabled:
+            tracer.spans.clear()
+            tracer.start()
+            self.notify("Press Ctrl+T again to stop and save the trace", title="Tracing")
+            return
+        tracer.stop()
+        name = datetime.datetime.now().strftime("trace-%Y%m%d-%H%M%S.json")
+        path = os.path.join(os.path.dirname(db.DB_PATH), "traces", name)
+        count = tracer.export(path)
+        self.notify(f"{count} spans saved to {path}", title="Tracing")
+
+
+def setup_tracing():
+    tracer.add_module(db, "db")
+    tracer.add_class(StealthIM.Server, "api")
+    tracer.add_class(StealthIM.User, "api")
+    tracer.add_class(StealthIM.Group, "api")
+    tracer.add_class(ChatScreen, "ui", ["add_message", "add_messages", "add_pending_message", "update_chat_title"])
+
 
 if __name__ == "__main__":
     StealthIM.logger.setLevel(logging.DEBUG)
@@ -64,4 +121,7 @@ if __name__ == "__main__":
     logger.setLevel(logging.DEBUG)
     logger.addHandler(TextualHandler())
 
-    IMApp().run()
+    app = IMApp()
+    if os.environ.get("STEALTHIM_TRACE"):
+        tracer.start()
+    app.run()
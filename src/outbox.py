@@ -0,0 +1,162 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional
+
+import StealthIM
+import codes
+import db
+from log import logger
+
+# Results that will never succeed on retry, the message is dropped from the outbox
+PERMANENT_ERRORS = frozenset({
+    codes.MESSAGE_EMPTY_UID,
+    codes.MESSAGE_EMPTY_GROUP_ID,
+    codes.MESSAGE_EMPTY_CONTENT,
+    codes.MESSAGE_UNKNOWN_TYPE,
+    codes.MESSAGE_EMPTY_MESSAGE_ID,
+    codes.MESSAGE_CONTENT_TOO_LONG,
+    codes.MESSAGE_MESSAGE_NOT_FOUND,
+    codes.MESSAGE_PERMISSION_DENIED,
+})
+
+OutboxCallback = Callable[[db.OutboxMessage, int], Awaitable[None]]
+
+
+class Outbox:
+    """Persisted queue of outgoing text messages.
+
+    Messages are written to the ``outbox`` table before they are sent, so nothing typed
+    is lost when a send fails or the client is closed. Each group is drained by its own
+    task, which has up to PIPELINE_DEPTH sends in flight, started in the outbox order.
+    Several groups are sent concurrently, and failures are retried with backoff.
+    """
+    MAX_CONCURRENT_GROUPS = 4
+    PIPELINE_DEPTH = 4
+    RETRY_DELAYS = (1, 2, 5, 10, 30)
+    # Seconds after its send a message stops waiting for its echo, it came some other way
+    # (with the history) and a later message with the same text is someone else's
+    ECHO_TIMEOUT = 30
+
+    def __init__(self, server_id: int, user: StealthIM.User, username: str):
+        self.server_id = server_id
+        self.user = user
+        self.username = username
+        self.callback: Optional[OutboxCallback] = None
+        # Sent messages waiting for their echo from the server, by group
+        self.awaiting_echo: dict[int, list[db.OutboxMessage]] = {}
+        # When the messages waiting for their echo were sent, by outbox id
+        self._sent_at: dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_GROUPS)
+
+    def put(self, group_id: int, text: str) -> db.OutboxMessage:
+        item = db.add_outbox_message(self.server_id, group_id, self.username, text)
+        self._wakeup.set()
+        return item
+
+    def pending(self, group_id: int) -> list[db.OutboxMessage]:
+        waiting = self.awaiting_echo.get(group_id, [])
+        # The one being sent is in both
+        sending = {item.id for item in waiting}
+        return waiting + [item for item in db.get_outbox_messages(self.server_id, group_id) if item.id not in sending]
+
+    def take_echo(self, group_id: int, username: str, text: str) -> Optional[db.OutboxMessage]:
+        """Find the sent message a server echo belongs to.
+
+        The server keeps no id of ours, so among the messages sent in the last ECHO_TIMEOUT
+        seconds with the same text the oldest one wins.
+        """
+        if username != self.username:
+            return None
+        waiting = self.awaiting_echo.get(group_id, [])
+        deadline = time.monotonic() - self.ECHO_TIMEOUT
+        for item in [item for item in waiting if self._sent_at.get(item.id, deadline) < deadline]:
+            self._forget(waiting, item)
+        for item in waiting:
+            if item.msg == text:
+                self._forget(waiting, item)
+                return item
+        return None
+
+    def drop_echoes(self, group_id: int) -> None:
+        """Stop waiting for the echoes of a group, its history has them once it is loaded again."""
+        for item in self.awaiting_echo.pop(group_id, []):
+            self._sent_at.pop(item.id, None)
+
+    def _forget(self, waiting: list[db.OutboxMessage], item: db.OutboxMessage) -> None:
+        waiting.remove(item)
+        self._sent_at.pop(item.id, None)
+
+    async def drain(self, callback: OutboxCallback) -> None:
+        """Send everything in the outbox, forever. ``callback`` gets each item with its result code."""
+        self.callback = callback
+        try:
+            while True:
+                self._wakeup.clear()
+                for item in db.get_outbox_messages(self.server_id):
+                    task = self._tasks.get(item.group_id)
+                    if task is None or task.done():
+                        self._tasks[item.group_id] = asyncio.create_task(self._drain_group(item.group_id))
+                await self._wakeup.wait()
+        finally:
+            for task in self._tasks.values():
+                task.cancel()
+            self._tasks.clear()
+
+    async def _drain_group(self, group_id: int) -> None:
+        group = StealthIM.Group(self.user, group_id)
+        while True:
+            async with self._semaphore:
+                delay = await self._send_pending(group)
+            if delay is None:
+                return
+            # Waiting without the slot, the other groups are sent meanwhile
+            await asyncio.sleep(delay)
+
+    async def _send_pending(self, group: StealthIM.Group) -> Optional[int]:
+        """Send the group's messages, PIPELINE_DEPTH at a time, until some fail.
+
+        Returns the seconds to wait before retrying the failed ones, None once the group's
+        outbox is empty.
+        """
+        group_id = group.group_id
+        while items := db.get_outbox_messages(self.server_id, group_id):
+            batch = items[:self.PIPELINE_DEPTH]
+            # The echo can arrive before the send returns
+            waiting = self.awaiting_echo.setdefault(group_id, [])
+            now = time.monotonic()
+            for item in batch:
+                waiting.append(item)
+                self._sent_at[item.id] = now
+            # Started in order, the server orders the messages as they arrive
+            results = await asyncio.gather(*(self._send(group, item) for item in batch))
+            delay = None
+            for item, code in zip(batch, results):
+                if code != codes.SUCCESS and item in waiting:
+                    self._forget(waiting, item)
+                if code == codes.SUCCESS or code in PERMANENT_ERRORS:
+                    db.delete_outbox_message(item.id)
+                    if self.callback:
+                        await self.callback(item, code)
+                    continue
+
+                item.attempts += 1
+                db.update_outbox_attempts(item.id, item.attempts)
+                retry = self.RETRY_DELAYS[min(item.attempts, len(self.RETRY_DELAYS)) - 1]
+                logger.warning(f"Send to group {group_id} failed ({code}), retry in {retry}s")
+                # The ones behind it in the batch may be through already, it follows them
+                delay = retry if delay is None else min(delay, retry)
+            if delay is not None:
+                return delay
+        return None
+
+    @staticmethod
+    async def _send(group: StealthIM.Group, item: db.OutboxMessage) -> int:
+        try:
+            res = await group.send_text(item.msg)
+        except Exception as e:
+            # Whatever went wrong, the message stays in the outbox and is sent again
+            logger.warning(f"Send failed: {e!r}")
+            return -1
+        return res.result.code
@@ -2,7 +2,9 @@
 # For unknown reason, the following code cannot be warped in a single if TYPE_CHECKING block
 from typing import TYPE_CHECKING, cast, TypeVar
 
+from textual._compositor import Compositor, ReflowResult
 from textual.containers import Container
+from textual.geometry import Size
 from textual.screen import Screen, ModalScreen
 
 if TYPE_CHECKING:
@@ -12,10 +14,35 @@ else:
         ...
 
 
+class LaidOutSize:
+    """Takes the size of the widget from its last layout.
+
+    Textual looks the widget up in the map of the screen instead, which is stale after a
+    scroll, and a widget out of view then has every widget placed again to be found.
+    """
+
+    @property
+    def size(self) -> Size:
+        return self.outer_size.region.shrink(self.styles.gutter).size
+
+
+class Compositor(Compositor):
+    def reflow(self, parent, size: Size) -> ReflowResult:
+        result = super().reflow(parent, size)
+        # Every widget was just placed, the map of them all is up to date. Left marked stale
+        # after a scroll, the next lookup of a widget would place them all again
+        self._full_map_invalidated = False
+        return result
+
+
 # noinspection PyRedeclaration
-class Screen(Screen):
+class Screen(LaidOutSize, Screen):
     SCREEN_NAME: str
 
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._compositor = Compositor()
+
     @property
     def app(self) -> IMApp:
         return cast(IMApp, super().app)
@@ -5,4 +5,7 @@ from .chat import ChatScreen
 from .common import AddServerScreenReturn, LoginUserScreenReturn, MessageData
 from .group_manage import (CreateGroupScreen, JoinGroupScreen, ModifyGroupPasswordScreen, ModifyGroupNameScreen,
                            InviteMemberScreen)
+from .send_file import SendFileScreen
+from .jump import JumpScreen
+from .perf import PerfScreen
 from .widgets import ChatMessage, TopDetectingScroll
@@ -1,10 +1,15 @@
 import asyncio
+import bisect
+import collections
 import datetime
 import math
 import os
-from typing import Optional, cast
+import sys
+import time
+from typing import Awaitable, Callable, Optional
 
 import platformdirs
+from rich.markup import escape
 from textual import events, on, work
 from textual.app import ComposeResult
 from textual.binding import Binding
@@ -19,11 +24,17 @@ import db
 import log
 import tools
 from StealthIM.apis.message import MessageType
-from patch import Screen, Container
-from .common import MessageData
+from outbox import Outbox
+from transfer import DownloadManager, TransferTask, UploadManager
+from patch import LaidOutSize, Screen, Container
+from tracing import tracer
+from .common import ListState, MessageData
 from .group_manage import InviteMemberScreen, JoinGroupScreen, CreateGroupScreen, ModifyGroupNameScreen, \
     ModifyGroupPasswordScreen, SetMemberScreen
-from .widgets import ChatMessage, FocusableLabel, Popup, PopupMenu, PopupPlane, TopDetectingScroll
+from .jump import JumpScreen, JumpTarget
+from .send_file import SendFileScreen
+from .widgets import FocusableLabel, MessageList, Popup, PopupMenu, PopupPlane, TopDetectingScroll, \
+    TransferPanel
 
 
 class GroupManagerContainer(Container):
@@ -188,6 +199,10 @@ class GroupManagerContainer(Container):
             self.parent.flush_groups()
 
 
+class RowCheckbox(LaidOutSize, Checkbox):
+    """Selects the row it is next to, hidden ones are shown again for the rows scrolled in."""
+
+
 class MessageSelectContainer(Container):
     DEFAULT_CSS = """
     MessageSelectContainer {
@@ -211,13 +226,18 @@ class MessageSelectContainer(Container):
         Binding("ctrl+d", "download", "Download", show=False),
     ]
 
-    def __init__(self, message_list: VerticalScroll):
+    def __init__(self, message_list: MessageList):
         super().__init__()
         self.message_count: Label | None = None
         self.checkbox_container: Container | None = None
         self.message_list = message_list
         self.last_int = None
-        self.selected: list[ChatMessage] = []
+        # Selected messages by msgid
+        self.selected: dict[int, MessageData] = {}
+        # Checkboxes of the rows in view
+        self.checkboxes: dict[MessageData, Checkbox] = {}
+        # Hidden checkboxes, shown again when more rows fit in view
+        self.spare: list[Checkbox] = []
 
     def compose(self) -> ComposeResult:
         with Horizontal():
@@ -231,10 +251,10 @@ class MessageSelectContainer(Container):
             yield Label("Ctrl+d: Download file")
         self.checkbox_container = checkbox_container
 
-    async def on_mount(self, event: events.Mount) -> None:
-        await self.callback_scroll(0, 0)
+    def on_mount(self, event: events.Mount) -> None:
+        self.watch(self.message_list, "scroll_y", self.callback_scroll)
 
-    async def callback_scroll(self, _, new):
+    def callback_scroll(self, _, new):
         rounded = round(new)
         if not math.isclose(new, rounded, abs_tol=1e-6) or self.last_int == rounded:
             return
@@ -243,23 +263,35 @@ class MessageSelectContainer(Container):
         if not self.is_mounted:
             return
 
-        messages = cast(list[ChatMessage], self.visible_children(self.message_list))
-
-        # 清空旧的 checkbox
-        await self.checkbox_container.remove_children()
-
-        # 根据可见消息重新生成 checkbox
-        for msg in messages:
-            # 计算相对 y 位置（消息的 virtual_region 是在 scroll 坐标系下的）
-            y = int(msg.virtual_region.y - self.message_list.scroll_y)
-
-            checkbox = Checkbox("Select", value=msg in self.selected)
-            # 用 inline-style 定位 checkbox
-            checkbox.styles.offset = (0, y)
-            checkbox.styles.position = "absolute"
-            checkbox.msg = msg
-
-            await self.checkbox_container.mount(checkbox)
+        scroll = self.message_list
+        offsets = scroll.offsets
+        visible = self.visible_range(scroll, rounded)
+        rows = scroll.rows[visible.start:visible.stop]
+        # The checkboxes of rows scrolled away go to the rows scrolled in, the others stay as they are
+        wanted = set(rows)
+        free = [self.checkboxes.pop(row) for row in list(self.checkboxes) if row not in wanted]
+        for i, row in zip(visible, rows):
+            checkbox = self.checkboxes.get(row)
+            if checkbox is None:
+                if free:
+                    checkbox = free.pop()
+                elif self.spare:
+                    checkbox = self.spare.pop()
+                    checkbox.display = True
+                else:
+                    checkbox = RowCheckbox("Select")
+                    # 用 inline-style 定位 checkbox
+                    checkbox.styles.position = "absolute"
+                    self.checkbox_container.mount(checkbox)
+                checkbox.msg = row
+                with checkbox.prevent(Checkbox.Changed):
+                    checkbox.value = row.msgid in self.selected
+                self.checkboxes[row] = checkbox
+            # 相对 y 位置（offsets 是在 scroll 坐标系下的）
+            checkbox.styles.offset = (0, offsets[i] - rounded)
+        for checkbox in free:
+            checkbox.display = False
+        self.spare.extend(free)
 
     @on(Checkbox.Changed)
     def on_check(self, event: Checkbox.Changed) -> None:
@@ -267,64 +299,116 @@ class MessageSelectContainer(Container):
         # noinspection PyUnresolvedReferences
         msg = checkbox.msg
         if event.value:
-            self.selected.append(msg)
+            self.selected[msg.msgid] = msg
         else:
-            self.selected.remove(msg)
+            self.selected.pop(msg.msgid, None)
         self.message_count.update(str(len(self.selected)))
 
-    def action_recall(self):
-        return
+    async def action_recall(self):
+        msgids = [msgid for msgid, msg in self.selected.items()
+                  if msgid >= 0 and msg.type != MessageType.Recall.value]
+        if not msgids:
+            self.notify("No message to recall", severity="error")
+            return
+        for msgid in msgids:
+            del self.selected[msgid]
+        self.message_count.update(str(len(self.selected)))
+        self.last_int = None
+        self.callback_scroll(None, self.message_list.scroll_y)
+        await self.screen.recall_messages(self.message_list, msgids)
 
     async def action_download(self):
-        if not (
-            files := [msg for msg in self.selected if msg.type == MessageType.File.value]
-        ):
+        # One download per file, even if it was sent several times
+        files = {msg.hash: msg for msg in self.selected.values() if msg.type == MessageType.File.value}
+        if not files:
             self.notify("No message to download", severity="error")
             return
 
-        download_path = platformdirs.user_downloads_path()
-        hashes = [msg.hash for msg in self.selected]
-        filenames = []
-        for msg in files:
-            filename = msg.text
+        download_path = str(platformdirs.user_downloads_path())
+        paths = {}
+        for msg in files.values():
+            filename = msg.msg
             # Remove invalid characters
             filename = "".join(c for c in filename if c not in r'\/:*?"<>|')
             if not filename:
                 filename = msg.hash
-            # Ensure the filename is unique
-            file_path = os.path.join(download_path, filename)
-            if os.path.exists(file_path):
-                base, ext = os.path.splitext(filename)
-                i = 1
-                while os.path.exists(os.path.join(download_path, f"{base}({i}){ext}")):
-                    i += 1
-                filename = f"{base}({i}){ext}"
-            filenames.append(filename)
-        await self.app.data.group.download_files(hashes, filenames, download_path)
+            # Ensure the filename is unique, unless it already is this file
+            paths[msg.hash] = self.screen.downloads.pick_path(download_path, filename, msg.hash)
+        self.screen.download_files(paths)
 
     @staticmethod
-    def visible_children(scroll_container: VerticalScroll):
-        return [
-            child for child in scroll_container.children
-            if scroll_container.window_region.contains_region(child.virtual_region)
-        ]
+    def visible_range(scroll_container: MessageList, y: int) -> range:
+        """Indexes of the rows which are entirely in view at scroll offset ``y``."""
+        offsets = scroll_container.offsets
+        height = scroll_container.scrollable_content_region.height
+        first = bisect.bisect_left(offsets, y)
+        last = bisect.bisect_right(offsets, y + height) - 1
+        return range(first, max(first, last))
 
 
 class ChatScreen(Screen):
     SCREEN_NAME = "Chat"
     CSS_PATH = "../../styles/chat.tcss"
 
-    LIMIT = 10
-
-    BINDINGS = [("ctrl+s", "select_msg", "Select message")]
+    # Pages of history fill this many screens of one line messages
+    PAGE_SCREENS = 2
+    # Lines of a one line text message, with its meta line and border
+    MESSAGE_LINES = 5
+    # Bounds of a page from the database
+    MIN_PAGE = 10
+    MAX_PAGE = 200
+    # The server hands out at most this many messages at once
+    SERVER_LIMIT = 256
+    # Every this much latency of the server doubles its batches again
+    LATENCY_STEP = 0.1
+    # Received messages are added together, at most once per frame
+    FRAME = 1 / 60
+    # Seconds to wait before receiving again after each failure in a row
+    RECEIVE_RETRY_DELAYS = (1, 2, 5, 10, 30)
+    # Recently viewed groups kept as they were shown, for switching back
+    VIEW_CACHE_SIZE = 8
+    # Lines from the top at which the older page is shown, the one after it is loaded then
+    PREFETCH_DISTANCE = 20
+    # Server pages loaded at most to find where a jump goes
+    MAX_BACKFILL_PAGES = 20
+    # Messages kept in the list, the oldest are dropped while reading the newest ones
+    # and loaded from the database again when scrolled back to
+    MAX_RESIDENT = int(os.environ.get("STEALTHIM_MAX_MESSAGES", 2000))
+
+    BINDINGS = [("ctrl+s", "select_msg", "Select message"), ("ctrl+g", "jump", "Jump to")]
 
     def __init__(self):
         super().__init__()
         self.groups_list: Optional[ListView] = None
         self.groups: list[int] = []
+        # The item of every group in groups_list, and the text it shows
+        self.group_items: dict[int, ListItem] = {}
+        self.group_labels: dict[int, str] = {}
         self.last_group: Optional[int] = None
         self.group: Optional[StealthIM.Group] = None
         self.message_worker: Optional[Worker] = None
+        self.outbox: Optional[Outbox] = None
+        # Shown messages which are still in the outbox, by outbox id
+        self.pending_messages: dict[int, MessageData] = {}
+        # What the message list showed for recent groups, by group id, the oldest first
+        self.views: collections.OrderedDict[int, ListState] = collections.OrderedDict()
+        # The page before the first shown message, loading in the background
+        self.older: Optional[asyncio.Task] = None
+        # A group is being loaded, the load may be cancelled halfway by a newer one
+        self.switching = False
+        # Average seconds the server takes for a page of history
+        self.fetch_latency = 0.0
+        # Nicknames and file sizes being looked up, shared by the pages waiting for them
+        self.lookups: dict[tuple[str, str], asyncio.Task] = {}
+        # Nicknames and file sizes looked up, shown with the next messages right away
+        self.resolved: dict[tuple[str, str], str] = {}
+        # The list shows older messages after a jump, not the newest ones, so received
+        # messages are only stored until it is scrolled down to them
+        self.detached = False
+        # Held while adding at the bottom, so pages and received messages stay in order
+        self.append_lock = asyncio.Lock()
+        self.downloads = DownloadManager(on_progress=self.on_transfer_progress)
+        self.uploads = UploadManager(on_progress=self.on_transfer_progress)
 
     def compose(self) -> ComposeResult:
         yield Label(f"Server: {self.app.data.server_db.name}  User: {self.app.data.user_db.username}")
@@ -351,15 +435,19 @@ class ChatScreen(Screen):
                     yield PopupPlane("...", id="group-menu", inner_widget=GroupManagerContainer())
 
                 # Message area (scrollable)
-                with TopDetectingScroll(id="messages"):
-                    ...
+                yield MessageList(self.app.data.user_db, id="messages", distance=self.PREFETCH_DISTANCE)
+
+                yield TransferPanel(id="transfers")
 
                 # Input area
                 with Vertical(id="input-area"):
                     yield TextArea(id="msg-input")
                     with Right(id="tools"):
+                        yield Button("File", id="send-file")
                         yield Button("Send", id="send")
-        yield Label("", id="status")
+        with Horizontal(id="status-bar"):
+            yield Label("", id="status")
+            yield Label("", id="resident")
         yield Footer()
 
     # Events
@@ -368,7 +456,10 @@ class ChatScreen(Screen):
     async def on_mount(self, _event: Event) -> None:
         group_menu = self.query_one("#group-menu", PopupPlane)
         group_menu.display = False
+        self.watch(self.query_one("#messages", MessageList), "resident", self.show_resident)
         self.flush_groups()
+        self.outbox = Outbox(self.app.data.server_db.id, self.app.data.user, self.app.data.user_db.username)
+        self.drain_outbox()
 
     @on(PopupMenu.Command, "#group-commands")
     async def on_group_menu_pressed(self, event: PopupMenu.Command) -> None:
@@ -377,12 +468,13 @@ class ChatScreen(Screen):
         elif event.name == "create_group":
             await self.create_group()
 
-    # Reload the messages when select another group
-    @work()
+    # Reload the messages when select another group, a newer selection cancels the load
+    @work(exclusive=True, group="change_group")
     @on(ListView.Selected, "#groups_list")
     async def on_change_group(self, event: ListView.Selected) -> None:
-        group_id = self.groups[event.index]
-        if group_id == self.last_group:
+        # noinspection PyUnresolvedReferences
+        group_id = event.item.group_id
+        if group_id == self.last_group and not self.switching:
             # The group is not changed
             return
 
@@ -394,84 +486,268 @@ class ChatScreen(Screen):
             # Stop the last message worker
             self.message_worker.cancel()
 
+        messages = self.query_one("#messages", MessageList)
+        if self.last_group is not None:
+            # Half loaded if that load was cancelled, not worth keeping
+            if not self.detached and not self.switching:
+                self.views[self.last_group] = messages.snapshot()
+                self.views.move_to_end(self.last_group)
+                while len(self.views) > self.VIEW_CACHE_SIZE:
+                    self.views.popitem(last=False)
+        if self.older:
+            self.older.cancel()
+            self.older = None
+        # Nicknames of the old group's messages, its views look them up again when shown
+        self.workers.cancel_group(self, "resolve")
+        self.switching = True
+        self.detached = False
+        messages.stop_watching_bottom()
         self.last_group = group_id
         self.group = StealthIM.Group(self.app.data.user, group_id)
         self.app.data.group = self.group
 
         await self.update_chat_title(group_id)
-        # Reset the scroll
-        messages = self.query_one("#messages", TopDetectingScroll)
-        messages.remove_children()
-
-        # First load messages from db
-        msgs = db.get_latest_messages(self.app.data.server_db.id, group_id, limit=self.LIMIT)
-        if msgs:
-            for msg in msgs:
-                message = self.build_msg_from_db(msg)
-                await self.add_message(messages, message)
+        view = self.views.pop(group_id, None)
+        newer = []
+        if view:
+            # Saved since it was left, e.g. by the message worker when it was stopped
+            limit = self.page_size()
+            newer = db.get_messages(self.app.data.server_db.id, group_id,
+                                    from_=view.rows[-1].msgid if view.rows else 0, limit=limit + 1)
+            if len(newer) > limit:
+                # Too far behind, load it again
+                view = None
+        if view:
+            # Viewed recently, shown as it was left
+            await messages.restore(view)
+            unresolved = [row for row in view.rows if row.nickname is None]
+            if unresolved:
+                self.resolve_shown(messages, self.group, unresolved)
+            await self.add_messages(messages, [self.build_msg_from_db(msg) for msg in newer] + self.outbox_rows())
+            if view.at_end:
+                messages.scroll_to_end()
+            self.watch_history(messages)
         else:
-            # A new group, we only get the newest LIMIT messages
-            # from_id=0, old_to_new=False means pull the latest messages
-            gen = self.group.receive_latest_text(limit=self.LIMIT)
-            msgs = [x async for x in gen][::-1]
-            for msg in msgs:
-                message = db.add_message(
-                    self.app.data.server_db.id, self.group.group_id, msg.type.value,
-                    msg.msg.replace("\n", "\n\n"),
-                    datetime.datetime.fromtimestamp(int(msg.time)), msg.username,
-                    msg.msgid, msg.hash
-                )
-                message = self.build_msg_from_db(message)
-                await self.add_message(messages, message)
-
-        messages.scroll_end()
-        messages.reset_watching()
+            await self.show_latest(messages)
 
         # Then start the message worker to receive
         self.message_worker = self.get_messages(messages)
+        self.switching = False
 
-    # Load more messages when scrolled to top
+    # Show the older page when scrolled near the top
     @work()
     @on(TopDetectingScroll.ScrolledToTop, "#messages")
     async def on_no_more_message(self, _event: TopDetectingScroll.ScrolledToTop):
-        messages = self.query_one("#messages", TopDetectingScroll)
-        if not messages.children:
+        messages = self.query_one("#messages", MessageList)
+        if not messages.rows:
             return
 
-        # First get messages from database
-        new_messages = db.get_messages(
-            self.app.data.server_db.id,
-            self.group.group_id,
-            from_=messages.children[0].msgid,
-            old_to_new=False,
-            limit=self.LIMIT
-        )
-        if new_messages:
-            distance_to_bottom = messages.max_scroll_y - messages.scroll_offset.y
-            for msg in new_messages[::-1]:
-                message = self.build_msg_from_db(msg)
-                await self.add_message(messages, message, bottom=False)
-
-                new_offset = messages.max_scroll_y - distance_to_bottom
-                messages.scroll_to(y=new_offset, animate=False)
+        group = self.group
+        if self.older is None:
+            self.prefetch_older(messages.rows[0].msgid)
+        page, more = await self.older
+        if self.group is not group:
+            return
+        self.older = None
+        if messages.take_above(page):
+            # Reached the top before the page was loaded, the list keeps the view in place
+            with tracer.span("ChatScreen.mount"):
+                await messages.prepend(page)
+        if more:
+            # The next one is loaded while this one is read
+            self.prefetch_older(messages.rows[0].msgid)
             messages.reset_watching()
-        else:
+
+    # Show the newer page when scrolled near the bottom, after a jump
+    @work()
+    @on(TopDetectingScroll.ScrolledToBottom, "#messages")
+    async def on_more_below(self, _event: TopDetectingScroll.ScrolledToBottom):
+        messages = self.query_one("#messages", MessageList)
+        if not self.detached or not messages.rows:
+            return
+
+        async with self.append_lock:
+            limit = self.page_size()
+            msgs = db.get_messages(self.app.data.server_db.id, self.group.group_id,
+                                   from_=messages.rows[-1].msgid, old_to_new=True, limit=limit)
+            page = [self.build_msg_from_db(msg) for msg in msgs]
+            if len(msgs) < limit:
+                # Up to the newest stored message, the received ones are shown again from now on
+                self.detached = False
+                page += self.outbox_rows()
+            await self.add_messages(messages, page)
+        if self.detached:
+            messages.reset_watching_bottom()
+
+    # Show the messages around a date or msgid
+    @work()
+    async def action_jump(self) -> None:
+        if not self.group:
+            self.notify("You need to select a group")
+            return
+        target = await self.app.push_screen_wait(JumpScreen())
+        if target is None:
+            return
+        group = self.group
+        found = await self.find_message(group, target)
+        if self.group is not group:
+            return
+        if found is None:
+            self.notify(f"[red]{target} is not in this group[/]", title="Jump", severity="error")
+            return
+        await self.show_around(self.query_one("#messages", MessageList), found)
+
+    def prefetch_older(self, msgid: int) -> None:
+        self.older = asyncio.create_task(self.load_older(self.group, msgid))
+
+    # The page before msgid, oldest first, and whether there may be more
+    async def load_older(self, group: StealthIM.Group, msgid: int) -> tuple[list[MessageData], bool]:
+        server_id = self.app.data.server_db.id
+        # First get messages from database, oldest first
+        msgs = db.get_messages(server_id, group.group_id, from_=msgid, old_to_new=False, limit=self.page_size())
+        more = True
+        if not msgs:
             # There's no more messages in the database, try to pull from server
-            oldest_msgid = db.get_group_msgid(self.group.group_id, self.app.data.server_db.id, False)
-            gen = self.group.receive_text(from_id=oldest_msgid, sync=False, limit=self.LIMIT)
-            msgs = [x async for x in gen]
-            self.log(msgs)
-            for msg in msgs:
-                message = db.add_message(
-                    self.app.data.server_db.id, self.group.group_id, msg.type.value,
-                    msg.msg.replace("\n", "\n\n"),
-                    datetime.datetime.fromtimestamp(int(msg.time)), msg.username,
-                    msg.msgid, msg.hash
-                )
-                message = self.build_msg_from_db(message)
-                await self.add_message(messages, message, bottom=False)
-            if len(msgs) >= self.LIMIT:
-                messages.reset_watching()
+            oldest_msgid = db.get_group_msgid(group.group_id, server_id, False)
+            limit = self.page_size(remote=True)
+            start = time.perf_counter()
+            gen = group.receive_text(from_id=oldest_msgid, sync=False, limit=limit)
+            received = [x async for x in gen]
+            self.record_latency(time.perf_counter() - start)
+            self.log(received)
+            # Newest first from the server
+            msgs, more = self.save_messages(group.group_id, received[::-1]), len(received) >= limit
+        page = [self.build_msg_from_db(msg) for msg in msgs]
+        if self.group is group and page:
+            messages = self.query_one("#messages", MessageList)
+            unresolved = self.fill_known(page)
+            if unresolved:
+                self.resolve_shown(messages, group, unresolved)
+            # Shown by the list itself, in the same frame the view comes near the top
+            messages.above = page
+        return page, more
+
+    # Show the newest page of the group, with the messages still in the outbox
+    async def show_latest(self, messages: MessageList) -> None:
+        group_id = self.group.group_id
+        self.detached = False
+        messages.stop_watching_bottom()
+        # Reset the scroll
+        await messages.clear()
+
+        # First load messages from db
+        msgs = db.get_latest_messages(self.app.data.server_db.id, group_id, limit=self.page_size())
+        if not msgs:
+            # A new group, we only get the newest page of messages
+            # from_id=0, old_to_new=False means pull the latest messages
+            start = time.perf_counter()
+            gen = self.group.receive_latest_text(limit=self.page_size(remote=True))
+            received = [x async for x in gen]
+            self.record_latency(time.perf_counter() - start)
+            msgs = self.save_messages(group_id, received[::-1])
+        await self.add_messages(messages, [self.build_msg_from_db(msg) for msg in msgs] + self.outbox_rows())
+
+        messages.scroll_to_end()
+        self.watch_history(messages)
+
+    # Show a window of pages around target, more are loaded when scrolled up or down
+    async def show_around(self, messages: MessageList, target: db.Message) -> None:
+        server_id = self.app.data.server_db.id
+        group_id = self.group.group_id
+        limit = self.page_size()
+        before = db.get_messages(server_id, group_id, from_=target.msgid, old_to_new=False, limit=limit)
+        # The target and the page after it
+        after = db.get_messages(server_id, group_id, from_=target.msgid - 1, old_to_new=True, limit=limit + 1)
+
+        async with self.append_lock:
+            self.detached = len(after) > limit
+            rows = [self.build_msg_from_db(msg) for msg in before + after]
+            if self.detached:
+                # The outbox is shown again below the newest messages
+                self.pending_messages.clear()
+            else:
+                rows += self.outbox_rows()
+            await messages.clear()
+            await self.add_messages(messages, rows)
+        # The target on top of the view
+        messages.scroll_to(y=messages.offsets[len(before)], animate=False)
+        self.watch_history(messages)
+        if self.detached:
+            messages.reset_watching_bottom()
+        else:
+            messages.stop_watching_bottom()
+
+    # The stored message a jump goes to, missing history is loaded from the server first
+    async def find_message(self, group: StealthIM.Group, target: JumpTarget) -> Optional[db.Message]:
+        server_id = self.app.data.server_db.id
+        group_id = group.group_id
+
+        def stored() -> bool:
+            # The history is stored from the oldest message on, up to the newest
+            if isinstance(target, int):
+                return db.get_group_msgid(group_id, server_id, False) <= target
+            return db.get_message_by_time(server_id, group_id, target, after=False) is not None
+
+        for _ in range(self.MAX_BACKFILL_PAGES):
+            if stored():
+                break
+            if not await self.backfill(group, db.get_group_msgid(group_id, server_id, False)):
+                # The start of the group
+                break
+
+        if isinstance(target, int):
+            found = db.get_message(server_id, group_id, target)
+            if found is None:
+                # Missed while the group was not open, or further back than the pages loaded
+                await self.backfill(group, target + 1)
+                found = db.get_message(server_id, group_id, target)
+            return found
+        return (db.get_message_by_time(server_id, group_id, target)
+                or db.get_message_by_time(server_id, group_id, target, after=False))
+
+    # Store the server page before from_id, skipping the stored messages, returns whether there may be older ones
+    async def backfill(self, group: StealthIM.Group, from_id: int) -> bool:
+        start = time.perf_counter()
+        gen = group.receive_text(from_id=from_id, sync=False, limit=self.SERVER_LIMIT)
+        received = [x async for x in gen]
+        self.record_latency(time.perf_counter() - start)
+        if received:
+            # Newest first from the server
+            stored = db.get_msgids(self.app.data.server_db.id, group.group_id, received[-1].msgid, received[0].msgid)
+            self.save_messages(group.group_id, [msg for msg in received[::-1] if msg.msgid not in stored])
+        return len(received) >= self.SERVER_LIMIT
+
+    # Messages still in the outbox, shown until the server confirms them
+    def outbox_rows(self) -> list[MessageData]:
+        self.pending_messages.clear()
+        return [self.build_pending_message(item) for item in self.outbox.pending(self.group.group_id)]
+
+    # Keep the page before the first shown message loaded, and show it when scrolled up
+    def watch_history(self, messages: MessageList) -> None:
+        if self.older:
+            self.older.cancel()
+            self.older = None
+        messages.above = None
+        if messages.rows and messages.rows[0].msgid >= 0:
+            self.prefetch_older(messages.rows[0].msgid)
+        messages.reset_watching()
+
+    # The label has a fixed width, so the count changing doesn't lay out the screen again
+    def show_resident(self, count: int) -> None:
+        self.query_one("#resident", Label).update(f"{count} messages loaded", layout=False)
+
+    # Messages to load at once, enough to fill PAGE_SCREENS of the message list
+    def page_size(self, remote: bool = False) -> int:
+        height = self.query_one("#messages", MessageList).scrollable_content_region.height or self.app.size.height
+        size = min(self.MAX_PAGE, max(self.MIN_PAGE, self.PAGE_SCREENS * height // self.MESSAGE_LINES))
+        if remote:
+            # Fewer round trips, the slower they are
+            size *= 2 ** (1 + int(self.fetch_latency / self.LATENCY_STEP))
+            size = min(self.SERVER_LIMIT, size)
+        return size
+
+    def record_latency(self, seconds: float) -> None:
+        self.fetch_latency = seconds if not self.fetch_latency else self.fetch_latency * 0.7 + seconds * 0.3
 
     # Catch the Ctrl+Enter on the input
     @on(Key)
@@ -486,14 +762,31 @@ class ChatScreen(Screen):
     async def on_send_by_btn(self, _event: Event) -> None:
         self.do_send()
 
+    @work()
+    @on(Button.Pressed, "#send-file")
+    async def on_send_file(self, _event: Event) -> None:
+        if not self.group:
+            self.notify("You need to select a group")
+            return
+        group = self.group
+        path = await self.app.push_screen_wait(SendFileScreen())
+        if not path:
+            return
+        task = await self.uploads.upload(group, path)
+        if task.status == "failed":
+            self.notify(f"[red]{task.error}[/]", title=f"Failed to send {task.filename}", severity="error")
+        self.set_timer(3, self.clear_transfers)
+
     async def action_select_msg(self):
         if not self.group:
             self.notify("You need to select a group")
             return
-        scroll = self.query_one("#messages", TopDetectingScroll)
+        scroll = self.query_one("#messages", MessageList)
 
+        if self.query(MessageSelectContainer):
+            # Already selecting
+            return
         container = MessageSelectContainer(scroll)
-        self.watch(scroll, "scroll_y", container.callback_scroll)
         popup = Popup(container, position="left")
         self.mount(popup)
         await popup.show_popup()
@@ -501,28 +794,172 @@ class ChatScreen(Screen):
     # Helper functions
 
     # Add a message in the scroll
-    async def add_message(self, scroll: VerticalScroll, message: MessageData, bottom=True):
-        sender_res = await db.get_nickname(self.app.data.server_db.id, self.app.data.user, message.username)
-        if sender_res.result.code != codes.SUCCESS:
-            message.nickname = "未知"
-        else:
-            message.nickname = sender_res.nickname
-        if bottom:
-            attr = {"after": -1}
-        else:
-            attr = {"before": 0}
+    async def add_message(self, scroll: MessageList, message: MessageData, bottom=True,
+                          state: Optional[str] = None) -> MessageData:
+        if state is not None:
+            message.state = state
+        await self.add_messages(scroll, [message], bottom)
+        return message
+
+    # Add a page of messages in the scroll at once, oldest first
+    async def add_messages(self, scroll: MessageList, messages: list[MessageData], bottom=True) -> None:
+        if not messages:
+            return
+        near_end = bottom and scroll.near_end()
+        unresolved = self.fill_known(messages)
+        with tracer.span("ChatScreen.mount"):
+            if bottom:
+                await scroll.append(messages)
+            else:
+                await scroll.prepend(messages)
+        if near_end and len(scroll.rows) > self.MAX_RESIDENT and await scroll.evict(self.MAX_RESIDENT):
+            # The older page to load is another one now
+            self.watch_history(scroll)
+        if unresolved:
+            # Shown with the usernames first, the nicknames and file sizes follow
+            self.resolve_shown(scroll, self.group, unresolved)
+
+    @work(group="resolve")
+    async def resolve_shown(self, scroll: MessageList, group: StealthIM.Group, messages: list[MessageData]) -> None:
+        await self.resolve_messages(group, messages)
+        for message in messages:
+            scroll.refresh_row(message)
+
+    # Fill in the nicknames and file sizes looked up before, returns the messages still missing some
+    def fill_known(self, messages: list[MessageData]) -> list[MessageData]:
+        unresolved = []
+        for message in messages:
+            if message.nickname is None:
+                message.nickname = self.resolved.get(("nickname", message.username))
+            if message.type == MessageType.File.value and message.size is None:
+                message.size = self.resolved.get(("size", message.hash))
+            if not self.is_resolved(message):
+                unresolved.append(message)
+        return unresolved
 
-        if message.type == MessageType.File.value:
-            file_res = await db.get_file_size(self.group, message.hash)
-            message.size = tools.int2size(int(file_res))
+    @staticmethod
+    def is_resolved(message: MessageData) -> bool:
+        return message.nickname is not None and (message.type != MessageType.File.value or message.size is not None)
+
+    # Fill in the nicknames and file sizes, of the messages which don't have them yet
+    async def resolve_messages(self, group: StealthIM.Group, messages: list[MessageData]) -> None:
+        messages = [message for message in messages if not self.is_resolved(message)]
+        # Looked up once for every sender and file in the page, all at the same time
+        usernames = list({message.username for message in messages})
+        hashes = list({message.hash for message in messages
+                       if message.type == MessageType.File.value and message.size is None})
+        results = await asyncio.gather(
+            *(self.lookup("nickname", username, lambda u=username: self.fetch_nickname(u)) for username in usernames),
+            *(self.lookup("size", hash_, lambda h=hash_: self.fetch_size(group, h)) for hash_ in hashes),
+        )
+        nicknames = dict(zip(usernames, results))
+        sizes = dict(zip(hashes, results[len(usernames):]))
+        for message in messages:
+            message.nickname = nicknames[message.username]
+            if message.type == MessageType.File.value and message.size is None:
+                message.size = sizes[message.hash]
+
+    # The same lookup is made once, however many pages wait for it
+    async def lookup(self, kind: str, key: str, fetch: Callable[[], Awaitable[str]]) -> str:
+        task = self.lookups.get((kind, key))
+        if task is None:
+            task = self.lookups[(kind, key)] = asyncio.create_task(fetch())
+            task.add_done_callback(lambda _: self.lookups.pop((kind, key), None))
+        return await asyncio.shield(task)
+
+    async def fetch_nickname(self, username: str) -> str:
+        res = await db.get_nickname(self.app.data.server_db.id, self.app.data.user, username)
+        if res.result.code != codes.SUCCESS:
+            return "未知"
+        self.resolved[("nickname", username)] = res.nickname
+        return res.nickname
+
+    async def fetch_size(self, group: StealthIM.Group, hash_: str) -> str:
+        size = int(await db.get_file_size(group, hash_))
+        if size:
+            self.resolved[("size", hash_)] = tools.int2size(size)
+        return tools.int2size(size)
+
+    # Save messages from the server into the database, in one transaction
+    def save_messages(self, group_id: int, msgs: list) -> list[db.Message]:
+        return db.add_messages(self.app.data.server_db.id, group_id, [(
+            msg.type.value,
+            msg.msg.replace("\n", "\n\n"),
+            datetime.datetime.fromtimestamp(int(msg.time)), msg.username,
+            msg.msgid, msg.hash
+        ) for msg in msgs])
+
+    # Render an outbox item before the server confirms it
+    async def add_pending_message(self, scroll: MessageList, item: db.OutboxMessage) -> None:
+        message = self.build_pending_message(item)
+        await self.add_message(scroll, message)
+
+    def build_pending_message(self, item: db.OutboxMessage) -> MessageData:
+        message = MessageData(
+            server_id=item.server_id,
+            group_id=item.group_id,
+            type=MessageType.Text.value,
+            msgid=-item.id,
+            msg=item.msg.replace("\n", "\n\n"),
+            time=item.time,
+            username=item.username,
+            hash="",
+            state="pending",
+        )
+        # Registered first, the echo may arrive while it is being added
+        self.pending_messages[item.id] = message
+        return message
 
-        await scroll.mount(
-            ChatMessage(message, self.app.data.user_db),
-            **attr
+    async def on_outbox_result(self, item: db.OutboxMessage, code: int) -> None:
+        if code == codes.SUCCESS:
+            # Stays pending until the echo arrives with its msgid
+            return
+        message = self.pending_messages.pop(item.id, None)
+        if message:
+            message.state = "failed"
+            self.query_one("#messages", MessageList).refresh_row(message)
+        self.notify(
+            f"[red]{code} ({codes.get_msg(code)})[/]",
+            title="Failed to send message",
+            severity="error",
         )
 
-    async def recall_message(self, scroll: VerticalScroll):
-        ...
+    # Recall messages of the current group, all requests at once
+    async def recall_messages(self, scroll: MessageList, msgids: list[int]) -> None:
+        group = self.group
+        # A request may raise (a bad response, the connection), that one failed and the others count
+        results = await asyncio.gather(*(group.recall_message(msgid) for msgid in msgids), return_exceptions=True)
+        recalled = []
+        failed: list[str] = []
+        for msgid, res in zip(msgids, results):
+            if isinstance(res, BaseException):
+                log.logger.warning(f"Recall of {msgid} failed: {res!r}")
+                failed.append(str(res) or type(res).__name__)
+            elif res.result.code != codes.SUCCESS:
+                failed.append(f"{res.result.code} ({codes.get_msg(res.result.code)})")
+            else:
+                recalled.append(msgid)
+        if recalled:
+            db.recall_messages(self.app.data.server_db.id, group.group_id, recalled)
+            if self.group is group:
+                self.show_recalled(scroll, recalled)
+        if failed:
+            self.notify(
+                f"[red]{len(failed)} of {len(msgids)}: {escape(failed[0])}[/]",
+                title="Failed to recall messages",
+                severity="error",
+            )
+
+    # Show messages as recalled, the ones in the list
+    @staticmethod
+    def show_recalled(scroll: MessageList, msgids: list[int]) -> None:
+        for msgid in msgids:
+            row = scroll.find(msgid)
+            if row is None or row.type == MessageType.Recall.value:
+                continue
+            row.type = MessageType.Recall.value
+            row.msg = ""
+            scroll.refresh_row(row)
 
     @staticmethod
     async def get_group_members(group):
@@ -550,17 +987,24 @@ class ChatScreen(Screen):
             chat_title.update(res.name)
 
     @staticmethod
-    def build_msg_from_db(msg: db.Message):
-        return MessageData(
-            group_id=msg.group_id,
-            server_id=msg.server_id,
-            msg=msg.msg,
-            type=msg.type,
-            time=msg.time,
-            username=msg.username,
-            msgid=msg.msgid,
-            hash=msg.hash,
-        )
+    def build_msg_from_db(msg: db.Message | db.Row) -> MessageData:
+        if isinstance(msg, db.Row):
+            # Unpacked, faster than by name, the columns are db.MESSAGE_COLUMNS
+            server_id, group_id, type_, msgid, text, time_, username, hash_ = msg
+        else:
+            server_id, group_id, type_, msgid = msg.server_id, msg.group_id, msg.type, msg.msgid
+            text, time_, username, hash_ = msg.msg, msg.time, msg.username, msg.hash
+        # The username is shared by all the messages of a sender
+        return MessageData(server_id, group_id, type_, msgid, text, time_, sys.intern(username), hash_)
+
+    def on_transfer_progress(self, _task: TransferTask) -> None:
+        self.query_one("#transfers", TransferPanel).update_tasks(self.uploads.tasks + self.downloads.tasks)
+
+    def clear_transfers(self) -> None:
+        if not self.downloads.active and not self.uploads.active:
+            self.downloads.clear_finished()
+            self.uploads.clear_finished()
+            self.on_transfer_progress(None)
 
     async def join_group(self):
         if await self.app.push_screen_wait(JoinGroupScreen.SCREEN_NAME):
@@ -572,17 +1016,13 @@ class ChatScreen(Screen):
 
     # Workers
 
-    # Update the groups
-    @work()
+    # Update the groups, only the items which changed
+    @work(exclusive=True, group="flush_groups")
     async def flush_groups(self) -> None:
         if self.groups_list is None:
             # The UI is not ready
             return
 
-        if self.message_worker:
-            # Stop the message worker
-            self.message_worker.cancel()
-
         status = self.query_one("#status", Label)
 
         # Get all the groups
@@ -592,51 +1032,184 @@ class ChatScreen(Screen):
                 f"[red]无法更新群组: {res.result.code}({codes.get_msg(res.result.code)}): {res.result.msg}[/]")
             return
 
-        await self.groups_list.clear()
-        self.groups = res.groups
-        for group_id in res.groups:
+        async def get_label(group_id: int) -> str:
             group = StealthIM.Group(self.app.data.user, group_id)
+            group_name, members = await asyncio.gather(self.get_group_name(group), self.get_group_members(group))
+            return f"{group_id}. {group_name} ({members})"
+
+        labels = dict(zip(res.groups, await asyncio.gather(*map(get_label, res.groups))))
+        highlighted = self.groups_list.highlighted_child
+
+        # Groups we are not in any more
+        removed = [group_id for group_id in self.group_items if group_id not in labels]
+        if removed:
+            await self.groups_list.remove_children([self.group_items.pop(group_id) for group_id in removed])
+            for group_id in removed:
+                del self.group_labels[group_id]
+        for group_id in removed:
+            self.views.pop(group_id, None)
+        if self.last_group in removed:
+            # Nothing more to receive from it
+            if self.message_worker:
+                self.message_worker.cancel()
+            self.last_group = None
+
+        for index, group_id in enumerate(res.groups):
+            item = self.group_items.get(group_id)
+            if item is None:
+                item = self.group_items[group_id] = ListItem(Label(labels[group_id]))
+                item.group_id = group_id
+                self.group_labels[group_id] = labels[group_id]
+                await self.groups_list.insert(index, [item])
+                continue
+            if self.groups_list.children[index] is not item:
+                self.groups_list.move_child(item, before=index)
+            if self.group_labels[group_id] != labels[group_id]:
+                self.group_labels[group_id] = labels[group_id]
+                item.query_one(Label).update(labels[group_id])
+        self.groups = res.groups
 
-            group_name = await self.get_group_name(group)
-            members = await self.get_group_members(group)
-
-            await self.groups_list.append(ListItem(Label(f"{group_id}. {group_name} ({members})")))
+        # Keep the highlight on the same group
+        if highlighted in self.groups_list.children:
+            self.groups_list.index = self.groups_list.children.index(highlighted)
 
     # Send the message in the input
     @work()
     async def do_send(self):
         text_area = self.query_one("#msg-input", TextArea)
         text = text_area.text
+        if not self.group or not text.strip():
+            return
         text_area.text = ""
-        if not self.group:
+        item = self.outbox.put(self.group.group_id, text)
+        messages = self.query_one("#messages", MessageList)
+        if self.detached:
+            # Back to the newest messages, with this one from the outbox
+            await self.show_latest(messages)
             return
-        await self.group.send_text(text)
-        messages = self.query_one("#messages", TopDetectingScroll)
+        await self.add_pending_message(messages, item)
         messages.scroll_end()
 
+    # Download files into the given paths, by file hash
+    @work()
+    async def download_files(self, paths: dict[str, str]) -> None:
+        group = self.group
+        tasks = await asyncio.gather(*(
+            self.downloads.download(group, file_hash, path) for file_hash, path in paths.items()
+        ))
+        failed = [task for task in tasks if task.status == "failed"]
+        if failed:
+            self.notify(f"{len(failed)} of {len(tasks)} files failed", title="Download", severity="error")
+        else:
+            self.notify(f"{len(tasks)} files saved to {os.path.dirname(tasks[0].path)}", title="Download")
+        self.set_timer(3, self.clear_transfers)
+
+    # Send everything in the outbox, retrying until the server accepts it
+    @work()
+    async def drain_outbox(self) -> None:
+        await self.outbox.drain(self.on_outbox_result)
+
     # The actual worker to update the group list
     @work()
-    async def get_messages(self, messages: VerticalScroll) -> None:
-        server_id = self.app.data.server_db.id
+    async def get_messages(self, messages: MessageList) -> None:
         group_id = self.group.group_id
-
-        while True:
-            try:
-                gen = self.group.receive_new_text(limit=self.LIMIT)
-                async for message in gen:
-                    msg = db.add_message(
-                        server_id, group_id, message.type.value,
-                        message.msg.replace("\n", "\n\n"),
-                        datetime.datetime.fromtimestamp(int(message.time)), message.username,
-                        message.msgid, message.hash
-                    )
-
-                    # if message.type != MessageType.Recall:
-                    await self.add_message(messages, self.build_msg_from_db(msg))
-                    # else:
-                    #     db.recall_message(server_id, group_id, message.msgid)
-                    #     await self.recall_message(messages, message.msgid)
-            except RuntimeError:
-                pass
-            except asyncio.CancelledError:
-                break
+        incoming = []
+        received = asyncio.Event()
+
+        async def receive() -> None:
+            failures = 0
+            while True:
+                delivered = False
+                try:
+                    async for message in self.group.receive_new_text(limit=self.SERVER_LIMIT):
+                        delivered = True
+                        incoming.append(message)
+                        received.set()
+                    if delivered:
+                        # Closed by the server after some messages, opened again right away
+                        failures = 0
+                        continue
+                    error = "closed"
+                except Exception as e:
+                    # Also a malformed frame, the live messages go on after it
+                    error = repr(e)
+                # Retried less and less often while the server stays unreachable
+                failures = 1 if delivered else failures + 1
+                delay = self.RECEIVE_RETRY_DELAYS[min(failures, len(self.RECEIVE_RETRY_DELAYS)) - 1]
+                log.logger.warning(f"Receiving group {group_id} failed ({error}), retry in {delay}s")
+                await asyncio.sleep(delay)
+
+        # Messages arriving within a frame of the last ones added are stored and mounted together
+        receiver = asyncio.create_task(receive())
+        added = 0.0
+        try:
+            while True:
+                await received.wait()
+                wait = added + self.FRAME - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                received.clear()
+                batch = incoming[:]
+                incoming.clear()
+                new = self.take_new_messages(messages, group_id, batch)
+                if self.detached:
+                    # Shown when scrolled down to them
+                    continue
+                async with self.append_lock:
+                    await self.add_messages(messages, new)
+                added = time.monotonic()
+        finally:
+            receiver.cancel()
+            if incoming:
+                # Received but not shown yet, they are loaded from the database next time
+                saved, _ = self.store_received(group_id, incoming)
+                for _, item in saved:
+                    if item:
+                        self.pending_messages.pop(item.id, None)
+            if self.group is None or self.group.group_id != group_id:
+                # The echoes of this group won't be received any more, until it is shown again
+                self.outbox.drop_echoes(group_id)
+
+    def store_received(self, group_id: int,
+                       batch: list) -> tuple[list[tuple[db.Message, Optional[db.OutboxMessage]]], list[int]]:
+        """Save received messages and apply the recalls among them.
+
+        Returns the saved messages, each with the outbox item it is the echo of (or None),
+        and the recalled msgids.
+        """
+        # A recall comes as the recalled message again, changed
+        recalled = [message.msgid for message in batch if message.type == MessageType.Recall]
+        if recalled:
+            batch = [message for message in batch if message.type != MessageType.Recall]
+        saved = []
+        for message, msg in zip(batch, self.save_messages(group_id, batch)):
+            item = None
+            if message.type == MessageType.Text:
+                item = self.outbox.take_echo(group_id, message.username, message.msg)
+            saved.append((msg, item))
+        if recalled:
+            db.recall_messages(self.app.data.server_db.id, group_id, recalled)
+        return saved, recalled
+
+    def take_new_messages(self, scroll: MessageList, group_id: int, batch: list) -> list[MessageData]:
+        """Save received messages, returns the ones to add to the list."""
+        saved, recalled = self.store_received(group_id, batch)
+        new = []
+        for msg, item in saved:
+            # Our own message coming back, confirm the pending one instead of adding it again
+            if item and (pending := self.pending_messages.pop(item.id, None)):
+                scroll.renumber(pending, msg.msgid)
+                pending.time = msg.time
+                pending.state = None
+                scroll.refresh_row(pending)
+                continue
+            new.append(self.build_msg_from_db(msg))
+        if recalled:
+            self.show_recalled(scroll, recalled)
+            # Recalled within the same batch
+            recalled_set = set(recalled)
+            for row in new:
+                if row.msgid in recalled_set:
+                    row.type = MessageType.Recall.value
+                    row.msg = ""
+        return new
@@ -19,7 +19,8 @@ class CondManage(AbstractContextManager):
         return self._ctx.__exit__(exc_type, exc_value, traceback)
 
 
-@dataclasses.dataclass()
+# Compared by identity, a row of the message list. Slotted, there may be many thousands
+@dataclasses.dataclass(eq=False, slots=True)
 class MessageData:
     server_id: int
     group_id: int
@@ -31,6 +32,18 @@ class MessageData:
     hash: str
     nickname: Optional[str] = None
     size: Optional[str] = None
+    # "pending" or "failed" for messages still in the outbox
+    state: Optional[str] = None
+
+
+# What a MessageList shows, to show it again later
+@dataclasses.dataclass
+class ListState:
+    rows: list[MessageData]
+    heights: list[int]
+    width: int
+    scroll_y: float
+    at_end: bool
 
 
 @dataclasses.dataclass
@@ -38,6 +51,7 @@ class AddServerScreenReturn:
     user_cancelled: bool
     name: Optional[str] = None
     url: Optional[str] = None
+    extra_urls: list[str] = dataclasses.field(default_factory=list)
 
 
 @dataclasses.dataclass
@@ -0,0 +1,59 @@
+import datetime
+from typing import Optional, Union
+
+from textual import on
+from textual.app import ComposeResult
+from textual.containers import Horizontal, Vertical
+from textual.widgets import Button, Input, Label
+
+from patch import ModalScreen
+
+# A msgid, or the time to show the messages from
+JumpTarget = Union[int, datetime.datetime]
+
+
+def parse_target(text: str) -> Optional[JumpTarget]:
+    """``#123`` or ``123`` is a msgid, anything else a date like ``2024-05-01`` or ``2024-05-01 18:30``."""
+    text = text.strip().removeprefix("#")
+    if text.isdigit():
+        return int(text)
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        return None
+
+
+class JumpScreen(ModalScreen[Optional[JumpTarget]]):
+    SCREEN_NAME = "Jump"
+    CSS_PATH = "../../styles/jump.tcss"
+
+    def __init__(self):
+        super().__init__()
+        self.target: Optional[Input] = None
+
+    def compose(self) -> ComposeResult:
+        with Vertical(id="jump-container"):
+            self.target = Input(placeholder="Date (2024-05-01 18:30) or message ID", id="jump-target")
+            yield self.target
+            with Horizontal():
+                yield Button("Back", id="back")
+                yield Button("Jump", id="jump", variant="success")
+            yield Label("", id="status")
+
+    @on(Button.Pressed, "#back")
+    async def on_back(self, _event) -> None:
+        self.dismiss(None)
+
+    @on(Input.Submitted, "#jump-target")
+    @on(Button.Pressed, "#jump")
+    async def on_jump(self, _event) -> None:
+        status = self.query_one("#status", Label)
+        text = (self.target.value or "").strip()
+        if not text:
+            status.update("[red]Please enter a date or message ID[/]")
+            return
+        target = parse_target(text)
+        if target is None:
+            status.update("[red]Unknown date, use 2024-05-01 or 2024-05-01 18:30[/]")
+            return
+        self.dismiss(target)
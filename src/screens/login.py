@@ -1,4 +1,9 @@
 import asyncio
+import time
+from typing import Optional
+
+import aiohttp
+
 import StealthIM
 import codes
 import db
@@ -15,19 +20,23 @@ from .common import LoginUserScreenReturn
 class LoginScreen(Screen):
     SCREEN_NAME = "Login"
 
+    # How long a successful session check is trusted
+    SESSION_CHECK_TTL = 300
+
     def __init__(self):
         super().__init__()
         self.users = []
         self.user_list: ListView | None = None
+        self.labels: list[Label] = []
+        # Ids of the users whose session is being checked
+        self.checking: set[int] = set()
         self.logging = False
 
     def compose(self) -> ComposeResult:
         yield Header()
         yield Label(f"Server: {self.app.data.server_db.name}", id="server-label")
         self.users = db.load_users_from_db(self.app.data.server_db.id)
-        self.user_list = ListView(
-            *[ListItem(Label(user.username)) for user in self.users]
-        )
+        self.user_list = ListView(*self.user_items())
         yield self.user_list
         with Horizontal():
             yield Button("Back", id="back")
@@ -38,6 +47,59 @@ class LoginScreen(Screen):
         yield Label("", id="status")
         yield Footer()
 
+    def on_mount(self) -> None:
+        self.check_sessions()
+
+    def user_items(self) -> list[ListItem]:
+        self.labels = [Label(self.user_text(user)) for user in self.users]
+        return [ListItem(label) for label in self.labels]
+
+    def user_text(self, user: db.User) -> str:
+        valid = self.session_valid(user)
+        if valid is None and user.id in self.checking:
+            return f"{user.username}  [yellow]checking...[/]"
+        if valid is None:
+            return f"{user.username}  [yellow]unknown[/]"
+        if valid:
+            return f"{user.username}  [green]valid[/]"
+        return f"{user.username}  [red]expired[/]"
+
+    def session_valid(self, user: db.User) -> Optional[bool]:
+        """The cached result of the session check, None if it is unknown or too old."""
+        check = self.app.data.session_checks.get(user.id)
+        if check is None:
+            return None
+        valid, checked_at = check
+        if valid and time.monotonic() - checked_at > self.SESSION_CHECK_TTL:
+            return None
+        return valid
+
+    async def check_session(self, user: db.User) -> None:
+        self.checking.add(user.id)
+        try:
+            res = await StealthIM.User(self.app.data.server, user.session).get_self_info()
+        except (RuntimeError, aiohttp.ClientError, asyncio.TimeoutError):
+            # Can't tell, it will be checked again when logging in
+            self.app.data.session_checks.pop(user.id, None)
+        else:
+            if res.result.code == codes.SUCCESS:
+                self.app.data.session_checks[user.id] = (True, time.monotonic())
+            elif res.result.code == codes.AUTHENTICATION_FAILED:
+                self.app.data.session_checks[user.id] = (False, time.monotonic())
+        finally:
+            self.checking.discard(user.id)
+        for user_, label in zip(self.users, self.labels):
+            if user_.id == user.id:
+                label.update(self.user_text(user))
+
+    # Check the sessions of all the accounts at the same time
+    @work(exclusive=True, group="check")
+    async def check_sessions(self) -> None:
+        self.checking.update(user.id for user in self.users)
+        for user, label in zip(self.users, self.labels):
+            label.update(self.user_text(user))
+        await asyncio.gather(*(self.check_session(user) for user in self.users))
+
     @on(Button.Pressed, "#back")
     async def on_back(self, _event: Button) -> None:
         await self.app.pop_screen()
@@ -56,9 +118,8 @@ class LoginScreen(Screen):
         self.users = db.load_users_from_db(self.app.data.server_db.id)
         if self.user_list is not None:
             await self.user_list.clear()
-            await self.user_list.extend(
-                [ListItem(Label(user.username)) for user in self.users]
-            )
+            await self.user_list.extend(self.user_items())
+        self.check_sessions()
 
     @on(Button.Pressed, "#remove")
     async def on_remove(self, _event: Button) -> None:
@@ -70,6 +131,7 @@ class LoginScreen(Screen):
         user = self.users[idx]
         db.delete_user_from_db(user.id)
         self.users.pop(idx)
+        self.labels.pop(idx)
         await self.user_list.remove_items([idx])
 
     @on(Button.Pressed, "#register")
@@ -91,13 +153,21 @@ class LoginScreen(Screen):
 
         self.app.data.user_db = user
         self.app.data.user = StealthIM.User(self.app.data.server, user.session)
-        api_res = await self.app.data.user.get_self_info()
-        if api_res.result.code == codes.AUTHENTICATION_FAILED:
+        valid = self.session_valid(user)
+        if valid is None:
+            # Not checked yet, ask the server now
+            await self.check_session(user)
+            valid = self.session_valid(user)
+        if valid is False:
             res = await self.app.push_screen_wait(ReLoginScreen(user.username))
             if res.user_cancelled:
+                self.logging = False
                 return
             db.update_user_session(user.id, res.session)
+            self.app.data.session_checks[user.id] = (True, time.monotonic())
             user = db.get_user_from_db(user.id)
+            self.users[idx] = user
+            self.labels[idx].update(self.user_text(user))
             self.app.data.user_db = user
             self.app.data.user = StealthIM.User(self.app.data.server, user.session)
 
@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+from typing import Optional
+
+from textual.app import ComposeResult
+from textual.widgets import Static
+
+import db
+import tools
+from patch import ModalScreen
+from tracing import tracer
+
+# Seconds of spans the latencies are computed from
+WINDOW = 10
+
+
+def resident_memory() -> Optional[int]:
+    """Resident set size of this process in bytes, None where it can't be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak instead of current, the best there is without /proc
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentile(data: list[int], p: float) -> float:
+    """Milliseconds at percentile ``p`` of sorted durations in nanoseconds."""
+    return data[min(len(data) - 1, round(p / 100 * (len(data) - 1)))] / 1e6
+
+
+class PerfScreen(ModalScreen):
+    """Live counters over the current screen, toggled with F12.
+
+    Latencies come from the tracer, which is started while this screen is shown.
+    """
+    SCREEN_NAME = "Perf"
+    CSS_PATH = "../../styles/perf.tcss"
+
+    BINDINGS = [("escape", "app.pop_screen", "Close"), ("f12", "app.pop_screen", "Close")]
+
+    LAG_INTERVAL = 0.1
+
+    def __init__(self):
+        super().__init__()
+        self.owns_tracer = False
+        self.last_tick = 0.0
+        self.max_lag = 0.0
+        self.last_refresh = time.monotonic()
+        self.last_saved = db.saved_messages
+
+    def compose(self) -> ComposeResult:
+        yield Static("", id="perf")
+
+    def on_mount(self) -> None:
+        self.set_interval(1, self.refresh_stats)
+        self.set_interval(self.LAG_INTERVAL, self.measure_lag)
+
+    def on_screen_resume(self) -> None:
+        self.last_tick = self.last_refresh = time.monotonic()
+        self.last_saved = db.saved_messages
+        self.refresh_stats()
+
+    def on_screen_suspend(self) -> None:
+        if self.owns_tracer:
+            tracer.stop()
+            self.owns_tracer = False
+
+    def measure_lag(self) -> None:
+        now = time.monotonic()
+        self.max_lag = max(self.max_lag, now - self.last_tick - self.LAG_INTERVAL)
+        self.last_tick = now
+
+    def refresh_stats(self) -> None:
+        if not self.is_current:
+            return
+        if not tracer.enabled:
+            tracer.spans.clear()
+            tracer.start()
+            self.owns_tracer = True
+
+        # Spans of the last WINDOW seconds, the newest are at the end of the buffer
+        now = time.perf_counter_ns()
+        cutoff = now - WINDOW * 1_000_000_000
+        db_spans: list[int] = []
+        api_spans: dict[str, list[int]] = {}
+        for span in reversed(tracer.spans):
+            if span.start + span.duration < cutoff:
+                break
+            if span.cat == "db":
+                db_spans.append(span.duration)
+            elif span.cat == "api":
+                api_spans.setdefault(span.name, []).append(span.duration)
+
+        elapsed = time.monotonic() - self.last_refresh
+        ingested = (db.saved_messages - self.last_saved) / elapsed if elapsed > 0 else 0
+        self.last_refresh = time.monotonic()
+        self.last_saved = db.saved_messages
+
+        lines = [f"[b]Performance[/]  (last {WINDOW}s, F12 to close)", ""]
+        lines.append(f"Messages ingested  {ingested:.0f}/s")
+        if db_spans:
+            db_spans.sort()
+            lines.append(f"DB queries         {len(db_spans)}  "
+                         f"p50 {percentile(db_spans, 50):.2f}ms  p99 {percentile(db_spans, 99):.2f}ms")
+        else:
+            lines.append("DB queries         -")
+
+        lines.append("")
+        lines.append("API latency")
+        for name, durations in sorted(api_spans.items()):
+            durations.sort()
+            lines.append(f"  {name:<26} {len(durations):>4}  "
+                         f"p50 {percentile(durations, 50):>7.1f}ms  p99 {percentile(durations, 99):>7.1f}ms")
+        if not api_spans:
+            lines.append("  -")
+
+        lines.append("")
+        lines.append("Cache hit rate")
+        for cache in ("nickname", "group_name", "file_size"):
+            hits = db.cache_stats[f"{cache}.hit"]
+            total = hits + db.cache_stats[f"{cache}.miss"]
+            rate = f"{hits * 100 / total:.0f}%" if total else "-"
+            lines.append(f"  {cache:<12} {rate:>5}  ({hits}/{total})")
+
+        lines.append("")
+        lines.append(f"Widgets in #messages  {self.message_widgets()}")
+        lines.append(f"Event loop lag        {self.max_lag * 1000:.0f}ms")
+        memory = resident_memory()
+        lines.append(f"Resident memory       {tools.int2size(memory) if memory is not None else '-'}")
+        self.max_lag = 0.0
+
+        self.query_one("#perf", Static).update("\n".join(lines))
+
+    def message_widgets(self) -> str:
+        from .chat import ChatScreen
+        for screen in self.app.screen_stack:
+            if isinstance(screen, ChatScreen):
+                messages = screen.query_one("#messages")
+                return f"{len(messages.walk_children())} ({len(messages.rows)} messages)"
+        return "-"
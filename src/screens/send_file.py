@@ -0,0 +1,44 @@
+import os
+from typing import Optional
+
+from textual import on
+from textual.app import ComposeResult
+from textual.containers import Horizontal, Vertical
+from textual.widgets import Button, Input, Label
+
+from patch import ModalScreen
+
+
+class SendFileScreen(ModalScreen[Optional[str]]):
+    SCREEN_NAME = "SendFile"
+    CSS_PATH = "../../styles/send_file.tcss"
+
+    def __init__(self):
+        super().__init__()
+        self.path: Optional[Input] = None
+
+    def compose(self) -> ComposeResult:
+        with Vertical(id="send-file-container"):
+            self.path = Input(placeholder="File path", id="send-file-path")
+            yield self.path
+            with Horizontal():
+                yield Button("Back", id="back")
+                yield Button("Send", id="send", variant="success")
+            yield Label("", id="status")
+
+    @on(Button.Pressed, "#back")
+    async def on_back(self, _event) -> None:
+        self.dismiss(None)
+
+    @on(Input.Submitted, "#send-file-path")
+    @on(Button.Pressed, "#send")
+    async def on_send(self, _event) -> None:
+        path = os.path.expanduser((self.path.value or "").strip().strip('"'))
+        status = self.query_one("#status", Label)
+        if not path:
+            status.update("[red]Please enter the file path[/]")
+            return
+        if not os.path.isfile(path):
+            status.update("[red]File not found[/]")
+            return
+        self.dismiss(os.path.abspath(path))
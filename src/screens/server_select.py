@@ -1,4 +1,9 @@
-from typing import cast
+import asyncio
+import re
+import time
+from typing import Optional, cast
+
+import aiohttp
 
 import StealthIM
 import db
@@ -6,6 +11,7 @@ import db
 from textual import on, work
 from textual.app import ComposeResult
 from textual.containers import Horizontal, Grid
+from textual.timer import Timer
 from textual.widgets import Header, Footer, Button, Input, Static, ListView, ListItem, Label
 
 from patch import Screen, ModalScreen
@@ -15,17 +21,24 @@ from .common import AddServerScreenReturn
 class ServerSelectScreen(Screen):
     SCREEN_NAME = "ServerSelect"
 
+    PROBE_INTERVAL = 15
+    PROBE_TIMEOUT = 5
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.servers = db.load_servers_from_db()
         self.server_list: ListView | None = None
+        self.labels: list[Label] = []
+        # URLs of every server, by server id
+        self.endpoints: dict[int, list[str]] = {}
+        # Round trip time in ms of every probed URL, None if it is unreachable
+        self.rtts: dict[str, Optional[float]] = {}
+        self.probe_timer: Optional[Timer] = None
 
     def compose(self) -> ComposeResult:
         yield Header()
         yield Static("Please select a server: ")
-        self.server_list = ListView(
-            *[ListItem(Label(f"{srv.name} - {srv.url}")) for srv in self.servers]
-        )
+        self.server_list = ListView(*self.server_items())
         yield self.server_list
         with Horizontal():
             yield Button("Add Server", id="add")
@@ -34,6 +47,62 @@ class ServerSelectScreen(Screen):
         yield Label("", id="status")
         yield Footer()
 
+    def on_mount(self) -> None:
+        self.probe_all()
+        self.probe_timer = self.set_interval(self.PROBE_INTERVAL, self.probe_all)
+
+    def on_screen_suspend(self) -> None:
+        # Not shown, the servers are probed again when it is
+        if self.probe_timer:
+            self.probe_timer.pause()
+
+    def on_screen_resume(self) -> None:
+        if self.probe_timer:
+            self.probe_timer.resume()
+
+    def server_items(self) -> list[ListItem]:
+        self.endpoints = {srv.id: db.get_server_endpoints(srv) for srv in self.servers}
+        self.labels = [Label(self.server_text(srv)) for srv in self.servers]
+        return [ListItem(label) for label in self.labels]
+
+    def server_text(self, server: db.Server) -> str:
+        urls = self.endpoints[server.id]
+        best = self.best_endpoint(server)
+        text = f"{server.name} - {best or server.url}"
+        if len(urls) > 1:
+            text += f" (+{len(urls) - 1} endpoints)"
+        if best:
+            return f"{text}  [green]{self.rtts[best]:.0f} ms[/]"
+        if all(url in self.rtts for url in urls):
+            return f"{text}  [red]unreachable[/]"
+        return f"{text}  [yellow]probing...[/]"
+
+    def best_endpoint(self, server: db.Server) -> Optional[str]:
+        """The reachable URL with the lowest round trip time."""
+        reachable = [url for url in self.endpoints[server.id] if self.rtts.get(url) is not None]
+        return min(reachable, key=lambda url: self.rtts[url], default=None)
+
+    def update_labels(self) -> None:
+        for server, label in zip(self.servers, self.labels):
+            label.update(self.server_text(server))
+
+    async def probe(self, url: str) -> None:
+        start = time.perf_counter()
+        try:
+            ok = await asyncio.wait_for(StealthIM.Server(url).ping(), self.PROBE_TIMEOUT)
+        except (asyncio.TimeoutError, aiohttp.ClientError, OSError, ValueError):
+            ok = False
+        self.rtts[url] = (time.perf_counter() - start) * 1000 if ok else None
+        self.update_labels()
+
+    async def probe_servers(self, servers: list[db.Server]) -> None:
+        await asyncio.gather(*(self.probe(url) for srv in servers for url in self.endpoints[srv.id]))
+
+    # Ping every endpoint of every server at the same time
+    @work(exclusive=True, group="probe")
+    async def probe_all(self) -> None:
+        await self.probe_servers(self.servers)
+
     @on(Button.Pressed, "#delete")
     async def on_delete(self, _event: Button.Pressed) -> None:
         if not self.server_list or not self.servers:
@@ -43,8 +112,10 @@ class ServerSelectScreen(Screen):
             server = self.servers[idx]
             db.delete_server_from_db(server.id)
             self.servers.pop(idx)
+            self.labels.pop(idx)
             await self.server_list.remove_items([idx])
 
+    @work()
     @on(Button.Pressed, "#enter")
     async def on_login(self, _event: Button.Pressed) -> None:
         if not self.server_list or not self.servers:
@@ -52,7 +123,15 @@ class ServerSelectScreen(Screen):
         idx = self.server_list.index
         if idx is not None and 0 <= idx < len(self.servers):
             server = self.servers[idx]
-            self.app.data.server = StealthIM.Server(server.url)
+            url = self.best_endpoint(server)
+            if url is None:
+                # Not probed yet, or nothing answered last time
+                await self.probe_servers([server])
+                url = self.best_endpoint(server)
+            if url is None:
+                self.query_one("#status", Label).update("[red]Server unreachable[/]")
+                return
+            self.app.data.server = StealthIM.Server(url)
             self.app.data.server_db = server
             from .login import LoginScreen
             await self.app.push_screen(LoginScreen.SCREEN_NAME)
@@ -64,17 +143,17 @@ class ServerSelectScreen(Screen):
         ret = await self.app.push_screen_wait(AddServerScreen.SCREEN_NAME)
         if not (ret and not ret.user_cancelled and ret.name and ret.url):
             return
-        if not await StealthIM.Server(ret.url).ping():
+        urls = [ret.url, *ret.extra_urls]
+        await asyncio.gather(*(self.probe(url) for url in urls))
+        if all(self.rtts[url] is None for url in urls):
             status.update("[red]Server unreachable[/]")
             return
-        db.save_server_to_db(ret.name, ret.url)
+        db.save_server_to_db(ret.name, ret.url, ret.extra_urls)
         self.servers = db.load_servers_from_db()
 
         if self.server_list is not None:
             await self.server_list.clear()
-            await self.server_list.extend(
-                [ListItem(Label(f"{srv.name} - {srv.url}")) for srv in self.servers]
-            )
+            await self.server_list.extend(self.server_items())
 
 
 class AddServerScreen(ModalScreen[AddServerScreenReturn]):
@@ -92,7 +171,7 @@ class AddServerScreen(ModalScreen[AddServerScreenReturn]):
             Label("Server Name:"),
             name_input := Input(placeholder="Server Name"),
             Label("Server Address:"),
-            addr_input := Input(placeholder="example.com"),
+            addr_input := Input(placeholder="example.com, backup.example.com"),
             Button("Confirm Add", id="confirm"),
             Button("Cancel", id="cancel"),
             id="dialog"
@@ -105,12 +184,14 @@ class AddServerScreen(ModalScreen[AddServerScreenReturn]):
         if not (self.name_input and self.addr_input):
             return
         name = cast(str, self.name_input.value).strip()
-        address = cast(str, self.addr_input.value).strip()
-        if name and address:
+        # Several endpoints of the same server can be given, separated by commas or spaces
+        addresses = [address for address in re.split(r"[,\s]+", cast(str, self.addr_input.value)) if address]
+        if name and addresses:
             self.dismiss(AddServerScreenReturn(
                 user_cancelled=False,
                 name=name,
-                url=address,
+                url=addresses[0],
+                extra_urls=addresses[1:],
             ))
 
     @on(Button.Pressed, "#cancel")
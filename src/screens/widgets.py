@@ -1,19 +1,44 @@
+import bisect
+import functools
+import itertools
+import re
+from typing import Optional
+
+from rich.console import Console
+from rich.markdown import Markdown as RichMarkdown
+from rich.segment import Segment
+from rich.text import Text
 from textual import events, on
 from textual.app import ComposeResult
-from textual.containers import Container, Right, VerticalScroll
+from textual.await_complete import AwaitComplete
+from textual.containers import Container, Right, Vertical, VerticalScroll
 from textual.events import Click, Key
 from textual.message import Message
-from textual.reactive import reactive
+from textual.geometry import Size
+from textual.reactive import Reactive, reactive, var
 from textual.widget import Widget
-from textual.widgets import Label, ListItem, ListView, Markdown, Static
+from textual.strip import Strip
+from textual.widgets import Label, ListItem, ListView, Static
 
 import StealthIM
 import db
-from .common import CondManage, MessageData
+import tools
+from patch import LaidOutSize
+from .common import CondManage, ListState, MessageData
 
 
 class TopDetectingScroll(VerticalScroll):
-    do_watching = reactive(True)
+    """Posts ScrolledToTop once the view comes within ``distance`` lines of the top.
+
+    It is posted once, until ``reset_watching`` is called. ScrolledToBottom works the
+    same way at the bottom, but only after ``reset_watching_bottom``.
+    """
+    do_watching = var(True)
+    do_watching_bottom = var(False)
+
+    def __init__(self, *children: Widget, distance: float = 0.001, **kwargs) -> None:
+        super().__init__(*children, **kwargs)
+        self.distance = distance
 
     class ScrolledToTop(events.Event):
         def __init__(self, control: "TopDetectingScroll") -> None:
@@ -24,44 +49,568 @@ class TopDetectingScroll(VerticalScroll):
         def control(self) -> "TopDetectingScroll":
             return self.self
 
+    class ScrolledToBottom(events.Event):
+        def __init__(self, control: "TopDetectingScroll") -> None:
+            super().__init__()
+            self.self = control  # For Textual event routing
+
+        @property
+        def control(self) -> "TopDetectingScroll":
+            return self.self
+
     def watch_scroll_y(self, old: float, new: float) -> None:
         super().watch_scroll_y(old, new)
-        threshold = 0.001
-        if (new <= threshold) and (old is None or old > threshold) and self.do_watching:
+        if (new <= self.distance) and (old is None or old > self.distance) and self.do_watching:
             self.do_watching = False
             self.post_message(self.ScrolledToTop(self))
+        bottom = self.max_scroll_y - self.distance
+        if (new >= bottom) and (old is None or old < bottom) and self.do_watching_bottom:
+            self.do_watching_bottom = False
+            self.post_message(self.ScrolledToBottom(self))
 
     def reset_watching(self):
         self.do_watching = True
+        # Once the view is in place, it may still be near the top after loading
+        self.call_after_refresh(self._check_top)
+
+    def reset_watching_bottom(self):
+        self.do_watching_bottom = True
+        self.call_after_refresh(self._check_bottom)
+
+    def stop_watching_bottom(self):
+        self.do_watching_bottom = False
+
+    def _check_top(self) -> None:
+        if self.scroll_y <= self.distance and self.do_watching:
+            self.do_watching = False
+            self.post_message(self.ScrolledToTop(self))
+
+    def _check_bottom(self) -> None:
+        if self.scroll_y >= self.max_scroll_y - self.distance and self.do_watching_bottom:
+            self.do_watching_bottom = False
+            self.post_message(self.ScrolledToBottom(self))
+
+
+# Anything that could be markdown, text without it is shown as it is
+MARKDOWN_SYNTAX = re.compile(r"[*_`#>|~\[\]<]|^\s*(?:[-+*]|\d+[.)])\s|^ {4}|^\s*[-=]{3,}\s*$|https?://", re.M)
+
+# Rendered message bodies kept, by text and width
+RENDER_CACHE_SIZE = 4096
+
+
+def is_plain(text: str) -> bool:
+    return not MARKDOWN_SYNTAX.search(text)
+
+
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_body(text: str, width: int, console: Console) -> tuple[list[Segment], ...]:
+    """The lines of a message body at ``width``, the same text is only parsed and wrapped once.
+
+    Kept as segments, a Strip carries caches of its own, and thousands of them kept alive
+    made every full garbage collection long enough to drop frames.
+    """
+    renderable = Text(text) if is_plain(text) else RichMarkdown(text)
+    return tuple(console.render_lines(renderable, console.options.update_width(width), pad=False))
+
+
+class MessageBody(LaidOutSize, Widget):
+    """The text of a message, rendered line by line from ``render_body``.
+
+    Plain text skips the markdown parser, and every body is rendered once per width
+    however many times it is mounted, which is what a recycled message widget needs.
+    """
+    DEFAULT_CSS = """
+    MessageBody {
+        height: auto;
+    }
+    """
+
+    def __init__(self, text: str, id: str | None = None, classes: str | None = None) -> None:
+        super().__init__(id=id, classes=classes)
+        self.text = text
+
+    def update(self, text: str) -> None:
+        self.text = text
+        self.refresh(layout=True)
+
+    def lines(self, width: int) -> tuple[list[Segment], ...]:
+        return render_body(self.text, max(1, width), self.app.console)
+
+    def get_content_height(self, container, viewport, width: int) -> int:
+        return len(self.lines(width))
+
+    def render_line(self, y: int) -> Strip:
+        width = self.content_size.width
+        lines = self.lines(width)
+        style = self.rich_style
+        if y >= len(lines):
+            return Strip.blank(width, style)
+        return Strip(lines[y]).adjust_cell_length(width).apply_style(style)
+
+
+class RowLabel(LaidOutSize, Label):
+    """A label of a ChatMessage, updated out of view when the message widget is reused."""
+
 
+class ChatMessage(LaidOutSize, Static):
+    STATE_TEXT = {
+        "pending": "发送中...",
+        "failed": "发送失败",
+    }
+    SIZE_PLACEHOLDER = "..."
 
-class ChatMessage(Static):
-    def __init__(self, message: MessageData, user: db.User) -> None:
+    def __init__(self, message: MessageData, user: db.User, state: Optional[str] = None) -> None:
         me = message.username == user.username
         super().__init__(classes='me' if me else 'other')
-
-        self.text = message.msg
-        self.nickname = message.nickname
         self.me = me
-        self.time = message.time
-        self.msgid = message.msgid
+        if state:
+            message.state = state
+        # What the widgets inside are made for, the message may become another type later
         self.type = message.type
-        self.file_size = message.size
-        self.hash = message.hash
+        self.set_message(message)
+
+    def set_message(self, message: MessageData) -> None:
+        """Show another message of the same kind, or the changes of this one."""
+        self.message = message
+        for klass in self.STATE_TEXT:
+            self.set_class(klass == message.state, klass)
+        if self.is_mounted:
+            self.update_children()
+
+    def shown_text(self) -> tuple[str, str, str]:
+        """The meta line, the text and the file size to show."""
+        message = self.message
+        size = message.size if message.size is not None else self.SIZE_PLACEHOLDER
+        return self.meta_text(), message.msg, size
+
+    def update_children(self) -> None:
+        shown = self.shown_text()
+        if shown == self.shown:
+            return
+        meta, text, file_size = shown
+        self.query_one("#meta", Label).update(meta)
+        if self.type == StealthIM.apis.message.MessageType.Text.value:
+            if text != self.shown[1]:
+                self.query_one("#message", MessageBody).update(text)
+        elif self.type == StealthIM.apis.message.MessageType.File.value:
+            self.query_one("#file-name", Label).update(text)
+            self.query_one("#file-size", Label).update(file_size)
+        self.shown = shown
+
+    def on_mount(self) -> None:
+        # Changed between compose and mount
+        self.update_children()
+
+    def meta_text(self) -> str:
+        message = self.message
+        # The username until the nickname is looked up
+        nickname = message.nickname if message.nickname is not None else message.username
+        if message.state:
+            return f"{nickname} {message.time} ({self.STATE_TEXT[message.state]})"
+        return f"{nickname} {message.time}"
+
+    @staticmethod
+    def kind(message: MessageData, user: db.User) -> tuple[int, bool]:
+        """Messages of the same kind have the same widgets inside, so one can be reused for another."""
+        return message.type, message.username == user.username
+
+    @staticmethod
+    def estimate_height(message: MessageData, width: int) -> int:
+        """Lines the message takes at ``width``, before it is rendered."""
+        if message.type == StealthIM.apis.message.MessageType.Text.value:
+            # Meta line, the bordered box (60% wide) and its bottom margin
+            inner = max(1, int(width * 0.6) - 3)
+            paragraphs = message.msg.split("\n\n")
+            lines = sum(max(1, -(-len(paragraph) // inner)) for paragraph in paragraphs)
+            return 4 + lines + len(paragraphs) - 1
+        if message.type == StealthIM.apis.message.MessageType.File.value:
+            return 8
+        if message.type == StealthIM.apis.message.MessageType.Recall.value:
+            return 3
+        return 2
 
     def compose(self):
+        # What the children show, to skip updates that change nothing
+        self.shown = meta, text, file_size = self.shown_text()
         align = "right" if self.me else "left"
         with CondManage(self.me, Right):
-            yield Label(f"{self.nickname} {self.time}", id="meta", classes=f"meta {align}")
+            yield RowLabel(meta, id="meta", classes=f"meta {align}")
         with CondManage(self.me, Right):
             if self.type == StealthIM.apis.message.MessageType.Text.value:
-                yield Markdown(self.text, id="message", classes=f"msg")
+                yield MessageBody(text, id="message", classes=f"msg")
             elif self.type == StealthIM.apis.message.MessageType.File.value:
                 with Container(id="file-box"):
-                    yield Label(self.text, id="file-name")
-                    yield Label(self.file_size, id="file-size")
+                    yield RowLabel(text, id="file-name")
+                    yield RowLabel(file_size, id="file-size")
+            elif self.type == StealthIM.apis.message.MessageType.Recall.value:
+                yield RowLabel("消息已撤回", id="message", classes="recalled")
             else:
-                yield Label("不支持的消息类型", id="message")
+                yield RowLabel("不支持的消息类型", id="message")
+
+
+class Spacer(LaidOutSize, Widget):
+    """Stands in for the rows of a MessageList that are not mounted."""
+    DEFAULT_CSS = """
+    Spacer {
+        height: 0;
+    }
+    """
+    # Only its height counts, which the layout that changed it has already placed
+    virtual_size = Reactive(Size(0, 0), layout=False)
+
+
+class MessageList(TopDetectingScroll):
+    """The messages of a chat, virtualized.
+
+    Every message is a row with an estimated height, and only the rows near the viewport
+    are mounted as ChatMessage widgets, between two spacers standing in for the rest.
+    Rows scrolled away give their widget back to a pool of hidden ones, reused for the
+    next row of the same kind, so the widget count stays flat however much history is
+    viewed. Heights are corrected once a row is rendered, keeping the view in place.
+    """
+    # Rows mounted above and below the viewport
+    OVERSCAN = 4
+    # Hidden widgets kept for reuse, per kind
+    POOL_SIZE = 20
+
+    # How many rows are in the list
+    resident = var(0)
+    # The rows are placed by the layout that changed the height of the list, another layout
+    # for its new scrollable size would only repeat it
+    virtual_size = Reactive(Size(0, 0), layout=False)
+
+    def __init__(self, user: db.User, id: str | None = None, distance: float = 0.001) -> None:
+        super().__init__(id=id, distance=distance)
+        self.user = user
+        self.rows: list[MessageData] = []
+        self.heights: list[int] = []
+        self.mounted: dict[MessageData, ChatMessage] = {}
+        # Rows by msgid, entries of rows no longer in the list are left until it is cleared
+        self.by_msgid: dict[int, MessageData] = {}
+        self.pool: dict[tuple[int, bool], list[ChatMessage]] = {}
+        self.window = (0, 0)
+        self._offsets: Optional[list[int]] = None
+        self._width = 0
+        # An older page, added as soon as the view comes within ``distance`` of the top
+        self.above: Optional[list[MessageData]] = None
+        self.top_spacer = Spacer()
+        self.bottom_spacer = Spacer()
+
+    def compose(self) -> ComposeResult:
+        yield self.top_spacer
+        yield self.bottom_spacer
+
+    @property
+    def offsets(self) -> list[int]:
+        """Top of every row, and the total height at the end."""
+        if self._offsets is None:
+            self._offsets = [0, *itertools.accumulate(self.heights)]
+        return self._offsets
+
+    def estimate(self, row: MessageData) -> int:
+        return ChatMessage.estimate_height(row, self._width or self.size.width or 80)
+
+    def find(self, msgid: int) -> Optional[MessageData]:
+        """The row of the message ``msgid``, None if it isn't in the list."""
+        row = self.by_msgid.get(msgid)
+        return row if row is not None and row.msgid == msgid else None
+
+    def renumber(self, row: MessageData, msgid: int) -> None:
+        """Give a row the msgid the server assigned to it."""
+        row.msgid = msgid
+        self.by_msgid[msgid] = row
+
+    def near_end(self) -> bool:
+        """Whether the view is within a screen of the newest row."""
+        height = self.scrollable_content_region.height or self.size.height or 24
+        return self.scroll_y + 2 * height >= self.offsets[-1]
+
+    async def append(self, rows: list[MessageData]) -> None:
+        self.rows.extend(rows)
+        self.by_msgid.update((row.msgid, row) for row in rows)
+        self.resident = len(self.rows)
+        self.heights.extend(map(self.estimate, rows))
+        self._offsets = None
+        await self._update_window()
+
+    async def prepend(self, rows: list[MessageData]) -> None:
+        """Add older rows on top, the rows in view stay where they are."""
+        y = self.scroll_y + self._insert_above(rows)
+        await self._update_window(y)
+        self._scroll_now(y)
+
+    def take_above(self, rows: list[MessageData]) -> bool:
+        """Whether ``rows`` were still waiting in ``above``, they are not any more."""
+        if self.above is not rows:
+            return False
+        self.above = None
+        return True
+
+    def validate_scroll_y(self, value: float) -> float:
+        value = super().validate_scroll_y(value)
+        if (self.above and value <= self.distance < self.scroll_y
+                and not self.app.animator.is_being_animated(self, "scroll_y")):
+            # Added by the scroll that comes near the top, the top itself is never laid out
+            value += self._insert_above(self.above)
+            self.above = None
+            self._update_window(value)
+            self._fit_rows()
+            self.scroll_target_y = value
+            if self.do_watching:
+                # Time to load the next one
+                self.do_watching = False
+                self.post_message(self.ScrolledToTop(self))
+        return value
+
+    def _insert_above(self, rows: list[MessageData]) -> int:
+        """Put older rows before the others, returns their estimated height."""
+        heights = list(map(self.estimate, rows))
+        self.rows[:0] = rows
+        self.by_msgid.update((row.msgid, row) for row in rows)
+        self.resident = len(self.rows)
+        self.heights[:0] = heights
+        self._offsets = None
+        start, end = self.window
+        self.window = (start + len(rows), end + len(rows))
+        return sum(heights)
+
+    async def clear(self) -> None:
+        self.above = None
+        # Whoever fills the list again watches the top again
+        self.do_watching = False
+        self.rows.clear()
+        self.by_msgid.clear()
+        self.resident = 0
+        self.heights.clear()
+        self._offsets = None
+        await self._update_window(0)
+        self._scroll_now(0)
+
+    async def evict(self, keep: int) -> int:
+        """Drop the oldest rows above the mounted ones, down to ``keep`` rows.
+
+        The rows in view stay where they are, returns how many were dropped.
+        """
+        start, end = self.window
+        count = min(len(self.rows) - keep, start)
+        if count <= 0:
+            return 0
+        y = self.scroll_y - self.offsets[count]
+        # It went before the dropped rows
+        self.above = None
+        for row in self.rows[:count]:
+            if self.by_msgid.get(row.msgid) is row:
+                del self.by_msgid[row.msgid]
+        del self.rows[:count]
+        del self.heights[:count]
+        self._offsets = None
+        self.window = (start - count, end - count)
+        self.resident = len(self.rows)
+        await self._update_window(y)
+        self._scroll_now(y)
+        return count
+
+    def snapshot(self) -> ListState:
+        """The rows and scroll position, leaving out the rows the server has not confirmed."""
+        kept = [i for i, row in enumerate(self.rows) if row.msgid >= 0]
+        return ListState(
+            rows=[self.rows[i] for i in kept],
+            heights=[self.heights[i] for i in kept],
+            width=self._width,
+            scroll_y=self.scroll_y,
+            at_end=self.scroll_y >= self.max_scroll_y,
+        )
+
+    async def restore(self, state: ListState) -> None:
+        """Show what ``snapshot`` returned, at the same scroll position."""
+        self.above = None
+        self.rows = list(state.rows)
+        self.by_msgid = {row.msgid: row for row in self.rows}
+        self.resident = len(self.rows)
+        if state.width == self._width:
+            self.heights = list(state.heights)
+        else:
+            self.heights = list(map(self.estimate, self.rows))
+        self._offsets = None
+        await self._update_window(state.scroll_y)
+        self._scroll_now(state.scroll_y)
+
+    def scroll_to_end(self) -> None:
+        """Show the newest row, in the coming frame."""
+        self._scroll_now(self.offsets[-1] - self.scrollable_content_region.height)
+        # Rows not measured yet may turn out taller
+        self.scroll_end(animate=False)
+
+    def _scroll_now(self, y: float) -> None:
+        """Scroll to ``y`` in the coming layout, rather than in another one after it.
+
+        Until then the list keeps its last laid out height, which ``y`` would be cut to, and
+        its scrollbar, without which it would not scroll at all.
+        """
+        self._fit_rows()
+        self.scroll_to(y=y, animate=False, force=True, immediate=True)
+
+    def _fit_rows(self) -> None:
+        """Take the height of the rows as the scrollable height now, before the coming layout."""
+        height = self.offsets[-1]
+        self.virtual_size = self.virtual_size.with_height(height)
+        # Refreshed by the layout otherwise, which paints the scrollbar again in another frame
+        self.vertical_scrollbar.window_virtual_size = height
+
+    def refresh_row(self, row: MessageData) -> None:
+        """Show the changes of a row, if it is on screen."""
+        widget = self.mounted.get(row)
+        if widget is None:
+            return
+        if widget.type != row.type:
+            # Another kind now (a recalled message), it needs other widgets inside
+            del self.mounted[row]
+            widget.remove()
+            self._update_window()
+            return
+        widget.set_message(row)
+        self.call_after_refresh(self._measure)
+
+    def on_resize(self, event: events.Resize) -> None:
+        if event.size.width != self._width:
+            self._width = event.size.width
+            self.heights = list(map(self.estimate, self.rows))
+            self._offsets = None
+        self._update_window()
+
+    def watch_scroll_y(self, old: float, new: float) -> None:
+        super().watch_scroll_y(old, new)
+        first, last = self._visible(new)
+        start, end = self.window
+        if first < start or last > end:
+            self._update_window()
+
+    def _visible(self, y: float) -> tuple[int, int]:
+        offsets = self.offsets
+        height = self.scrollable_content_region.height or self.size.height or 24
+        first = max(0, bisect.bisect_right(offsets, y) - 1)
+        last = min(len(self.rows), bisect.bisect_left(offsets, y + height) + 1)
+        return first, last
+
+    def _update_window(self, y: Optional[float] = None) -> AwaitComplete:
+        """Mount the rows around ``y`` (the current scroll offset by default), release the others."""
+        first, last = self._visible(self.scroll_y if y is None else y)
+        start = max(0, first - self.OVERSCAN)
+        end = min(len(self.rows), last + self.OVERSCAN)
+        wanted = self.rows[start:end]
+        wanted_set = set(wanted)
+        for row in [row for row in self.mounted if row not in wanted_set]:
+            self._release(row)
+
+        mounts = []
+        anchor: Widget = self.top_spacer
+        for row in wanted:
+            widget = self.mounted.get(row)
+            if widget is None:
+                widget = self._acquire(row, anchor, mounts)
+                self.mounted[row] = widget
+            anchor = widget
+
+        offsets = self.offsets
+        self.top_spacer.styles.height = offsets[start]
+        self.bottom_spacer.styles.height = offsets[-1] - offsets[end]
+        self.window = (start, end)
+        self.call_after_refresh(self._measure)
+        return AwaitComplete(*mounts)
+
+    def _acquire(self, row: MessageData, after: Widget, mounts: list) -> ChatMessage:
+        pool = self.pool.get(ChatMessage.kind(row, self.user))
+        if pool:
+            widget = pool.pop()
+            widget.set_message(row)
+            widget.styles.height = None
+            self.move_child(widget, after=after)
+        else:
+            widget = ChatMessage(row, self.user)
+            mounts.append(self.mount(widget, after=after))
+        return widget
+
+    def _release(self, row: MessageData) -> None:
+        widget = self.mounted.pop(row)
+        pool = self.pool.setdefault(ChatMessage.kind(row, self.user), [])
+        if len(pool) < self.POOL_SIZE:
+            # Folded to no height rather than hidden, hiding a widget restyles all its siblings
+            widget.styles.height = 0
+            pool.append(widget)
+        else:
+            widget.remove()
+
+    def _measure(self) -> None:
+        """Replace the estimated heights of the mounted rows with the real ones."""
+        start, end = self.window
+        offsets = self.offsets
+        y = self.scroll_y
+        above = 0
+        changed = False
+        for i in range(start, min(end, len(self.rows))):
+            widget = self.mounted.get(self.rows[i])
+            if widget is None:
+                continue
+            height = widget.outer_size.height
+            if height <= 0 or height == self.heights[i]:
+                continue
+            if offsets[i + 1] <= y:
+                # Above the viewport, the view moves with it
+                above += height - self.heights[i]
+            self.heights[i] = height
+            changed = True
+        if not changed:
+            return
+        self._offsets = None
+        offsets = self.offsets
+        self.top_spacer.styles.height = offsets[start]
+        self.bottom_spacer.styles.height = offsets[-1] - offsets[min(end, len(self.rows))]
+        if above:
+            self._scroll_now(y + above)
+
+
+class TransferPanel(Vertical):
+    """One line per running transfer, with its progress and throughput."""
+    DEFAULT_CSS = """
+    TransferPanel {
+        height: auto;
+        max-height: 6;
+        border-top: solid gray;
+        padding: 0 1;
+    }
+    """
+
+    def __init__(self, id: str | None = None) -> None:
+        super().__init__(id=id)
+        self.lines: dict[int, Label] = {}
+        self.display = False
+
+    def update_tasks(self, tasks) -> None:
+        self.display = bool(tasks)
+        for key in list(self.lines):
+            if key not in map(id, tasks):
+                self.lines.pop(key).remove()
+        for task in tasks:
+            text = self.task_text(task)
+            if id(task) in self.lines:
+                self.lines[id(task)].update(text)
+            else:
+                self.lines[id(task)] = Label(text)
+                self.mount(self.lines[id(task)])
+
+    @staticmethod
+    def task_text(task) -> str:
+        if task.status == "failed":
+            return f"[red]{task.filename}: {task.error}[/]"
+        if task.status == "done":
+            if task.note:
+                return f"[green]{task.filename}: done ({task.note})[/]"
+            return f"[green]{task.filename}: done[/]"
+        if task.status in ("waiting", "verifying", "hashing"):
+            return f"{task.filename}: {task.status}..."
+        percent = task.done * 100 // task.size if task.size else 0
+        return (f"{task.filename}: {percent}% "
+                f"({tools.int2size(task.done)}/{tools.int2size(task.size)}) {tools.int2size(task.speed)}/s")
 
 
 class FocusableLabel(Label):
@@ -198,7 +747,10 @@ class Popup(CommonPopup):
         self.styles.display = "none"
 
     async def close_popup(self) -> None:
-        await super().close_popup()
+        if self._popup:
+            await super().close_popup()
+            # Shown once, it goes with its content
+            await self.remove()
 
 
 class PopupPlane(CommonPopup):
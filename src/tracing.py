@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import functools
+import inspect
+import itertools
+import json
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Iterator, Optional
+
+from log import logger
+
+# Spans kept in memory, the oldest ones are dropped first
+BUFFER_SIZE = 100_000
+
+
+class Span:
+    __slots__ = ("name", "cat", "start", "duration", "tid")
+
+    def __init__(self, name: str, cat: str, start: int, duration: int, tid: int):
+        self.name = name
+        self.cat = cat
+        self.start = start
+        self.duration = duration
+        self.tid = tid
+
+
+class Tracer:
+    """Records how long db, SDK and UI calls take, for a Chrome trace (chrome://tracing, Perfetto).
+
+    Nothing is wrapped while tracing is off, so it costs nothing then: ``start`` replaces
+    the traced functions with timing wrappers and ``stop`` puts the originals back.
+    Spans are kept in a ring buffer of BUFFER_SIZE.
+    """
+
+    def __init__(self, size: int = BUFFER_SIZE):
+        self.enabled = False
+        self.spans: collections.deque[Span] = collections.deque(maxlen=size)
+        # (owner, attribute) -> function, what start() traces
+        self.targets: dict[tuple[Any, str], str] = {}
+        self._originals: list[tuple[Any, str, Any]] = []
+        # Small ids for tasks and threads, so every one gets its own track in the trace
+        self._task_ids: weakref.WeakKeyDictionary[asyncio.Task, int] = weakref.WeakKeyDictionary()
+        self._tid_names: dict[int, str] = {}
+        self._counter = itertools.count(1)
+        self._origin = time.perf_counter_ns()
+
+    def add_module(self, module, cat: str) -> None:
+        """Trace every public function defined in ``module``."""
+        for name, obj in vars(module).items():
+            if inspect.isfunction(obj) and obj.__module__ == module.__name__ and not name.startswith("_"):
+                self.targets[(module, name)] = cat
+
+    def add_class(self, cls: type, cat: str, names: Optional[list[str]] = None) -> None:
+        """Trace the public methods of ``cls``, or only ``names``."""
+        for name, obj in vars(cls).items():
+            if not inspect.isfunction(obj):
+                continue
+            if (names is None and not name.startswith("_")) or (names and name in names):
+                self.targets[(cls, name)] = cat
+
+    def start(self) -> None:
+        if self.enabled:
+            return
+        for (owner, name), cat in self.targets.items():
+            original = getattr(owner, name)
+            label = f"{owner.__name__}.{name}"
+            self._originals.append((owner, name, original))
+            setattr(owner, name, self._wrap(original, label, cat))
+        self.enabled = True
+        logger.info(f"Tracing {len(self.targets)} functions")
+
+    def stop(self) -> None:
+        for owner, name, original in self._originals:
+            setattr(owner, name, original)
+        self._originals.clear()
+        self.enabled = False
+
+    def span(self, name: str, cat: str = "ui"):
+        """A span around a block of code, does nothing while tracing is off."""
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, cat)
+
+    @contextmanager
+    def _span(self, name: str, cat: str) -> Iterator[None]:
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(name, cat, start)
+
+    def record(self, name: str, cat: str, start: int) -> None:
+        self.spans.append(Span(name, cat, start, time.perf_counter_ns() - start, self._tid()))
+
+    def _tid(self) -> int:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is None:
+            tid = threading.get_ident()
+            if tid not in self._tid_names:
+                self._tid_names[tid] = threading.current_thread().name
+            return tid
+        tid = self._task_ids.get(task)
+        if tid is None:
+            tid = self._task_ids[task] = next(self._counter)
+            self._tid_names[tid] = task.get_name()
+        return tid
+
+    def _wrap(self, func: Callable, name: str, cat: str) -> Callable:
+        # Checked on the result, SDK methods are plain functions returning coroutines
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter_ns()
+            result = func(*args, **kwargs)
+            if inspect.iscoroutine(result):
+                return self._await(result, name, cat)
+            if inspect.isasyncgen(result):
+                return self._iterate(result, name, cat)
+            self.record(name, cat, start)
+            return result
+
+        return wrapper
+
+    async def _await(self, coro, name: str, cat: str):
+        start = time.perf_counter_ns()
+        try:
+            return await coro
+        finally:
+            self.record(name, cat, start)
+
+    async def _iterate(self, gen, name: str, cat: str):
+        # One span per item, the time spent waiting for it
+        try:
+            while True:
+                start = time.perf_counter_ns()
+                try:
+                    item = await gen.__anext__()
+                except StopAsyncIteration:
+                    self.record(name, cat, start)
+                    return
+                self.record(name, cat, start)
+                yield item
+        finally:
+            await gen.aclose()
+
+    def export(self, path: str) -> int:
+        """Write the spans as Chrome trace JSON, returns how many were written."""
+        pid = os.getpid()
+        spans = list(self.spans)
+        events = [{
+            "name": span.name,
+            "cat": span.cat,
+            "ph": "X",
+            "ts": (span.start - self._origin) / 1000,
+            "dur": span.duration / 1000,
+            "pid": pid,
+            "tid": span.tid,
+        } for span in spans]
+        events.extend({
+            "name": "thread_name",
+            "ph": "M",
+            "pid": pid,
+            "tid": tid,
+            "args": {"name": name},
+        } for tid, name in self._tid_names.items())
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return len(spans)
+
+
+tracer = Tracer()
@@ -0,0 +1,462 @@
+import asyncio
+import dataclasses
+import json
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Callable, Optional
+
+import aiohttp
+import blake3
+
+import StealthIM
+import codes
+import db
+from blobstore import BlobStore
+from StealthIM.apis.file import BLOCK_SIZE
+from log import logger
+
+END_BLOCK = 0xffffffff
+
+HASH_WORKERS = min(4, os.cpu_count() or 1)
+hash_executor = ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix="hash")
+# Writes of downloaded blocks, one thread so that the seek and the write of a block stay together
+file_executor = ThreadPoolExecutor(1, thread_name_prefix="file")
+
+
+def read_block(path: str, block: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(block * BLOCK_SIZE)
+        return f.read(BLOCK_SIZE)
+
+
+def write_block(f, offset: int, data: bytes) -> None:
+    f.seek(offset)
+    f.write(data)
+
+
+def hash_block(path: str, block: int) -> bytes:
+    return blake3.blake3(read_block(path, block)).digest()
+
+
+async def hash_file(path: str) -> str:
+    """The server's file hash: blake3 over the blake3 digests of every block.
+
+    Blocks are hashed in the hash thread pool, with only a few of them in memory at a time.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(HASH_WORKERS * 2)
+
+    async def one(block: int) -> bytes:
+        async with semaphore:
+            return await loop.run_in_executor(hash_executor, hash_block, path, block)
+
+    blocks = (os.path.getsize(path) + BLOCK_SIZE - 1) // BLOCK_SIZE
+    digests = await asyncio.gather(*(one(block) for block in range(blocks)))
+    return blake3.blake3(b"".join(digests)).hexdigest()
+
+
+async def stream_blocks(url: str, session: str, file_hash: str, range_header: Optional[str] = None):
+    """Yield (offset, data) for every block of a file download.
+
+    Same protocol as ``StealthIM.apis.file.download_file``, but every field is read
+    exactly, a short read of the stream must not shift the block framing.
+    """
+    headers = {
+        "Authorization": f"Bearer {session}"
+    }
+    if range_header:
+        headers["Range"] = range_header
+    async with aiohttp.ClientSession() as client:
+        async with client.get(f"{url}/api/v1/file/{file_hash}", headers=headers) as resp:
+            if resp.status not in (200, 206):
+                raise RuntimeError(f"Request failed with status: {resp.status}")
+            while True:
+                try:
+                    block_id, length = struct.unpack("<II", await resp.content.readexactly(8))
+                    data = await resp.content.readexactly(length)
+                except asyncio.IncompleteReadError:
+                    raise RuntimeError("Download interrupted")
+                if block_id == END_BLOCK:
+                    break
+                yield block_id * BLOCK_SIZE, data
+
+
+@dataclasses.dataclass
+class TransferTask:
+    filename: str
+    path: str
+    size: int = 0
+    done: int = 0
+    status: str = "waiting"
+    error: Optional[str] = None
+    # Shown next to "done"
+    note: Optional[str] = None
+    # (time, bytes done) samples for the throughput
+    samples: list[tuple[float, int]] = dataclasses.field(default_factory=list)
+
+    @property
+    def speed(self) -> float:
+        if len(self.samples) < 2:
+            return 0
+        (t0, b0), (t1, b1) = self.samples[0], self.samples[-1]
+        return (b1 - b0) / (t1 - t0) if t1 > t0 else 0
+
+    def sample(self) -> None:
+        now = time.monotonic()
+        self.samples.append((now, self.done))
+        # Keep the last few seconds only
+        while len(self.samples) > 2 and now - self.samples[0][0] > 3:
+            self.samples.pop(0)
+
+
+@dataclasses.dataclass
+class DownloadTask(TransferTask):
+    group: Optional[StealthIM.Group] = None
+    hash: str = ""
+    part_path: str = ""
+    # Finished blocks not recorded in the .part.json yet, and when it was last written
+    unsaved: int = 0
+    saved_at: float = 0
+
+    @property
+    def blocks_path(self) -> str:
+        return self.part_path + ".json"
+
+
+@dataclasses.dataclass
+class UploadTask(TransferTask):
+    # The server already had the content, nothing was sent
+    repeated: bool = False
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class DownloadManager:
+    """Downloads files with bounded concurrency.
+
+    Files are fetched into the blob store and materialized from there, so a file that
+    was downloaded before costs no network at all. Every file is written to
+    ``<hash>.part`` in the store with its finished blocks recorded in ``<hash>.part.json``,
+    so an interrupted download resumes from the missing blocks. Big files are fetched as
+    several ranges at once when the server honours ``Range``, and the result is checked
+    against the file hash in a worker thread before it is moved into the store.
+    """
+    MAX_CONCURRENT = 3
+    RANGES_PER_FILE = 4
+    # The finished blocks are recorded every SAVE_BLOCKS blocks or SAVE_INTERVAL seconds,
+    # the ones fetched since are fetched again after an interruption
+    SAVE_BLOCKS = 16
+    SAVE_INTERVAL = 2
+
+    def __init__(self, on_progress: Optional[Callable[[DownloadTask], None]] = None,
+                 store: Optional[BlobStore] = None):
+        self.tasks: list[DownloadTask] = []
+        self.on_progress = on_progress
+        self.store = store or BlobStore()
+        self._semaphore = asyncio.Semaphore(self.MAX_CONCURRENT)
+        # One download per hash at a time, the others wait and take it from the store
+        self._locks: dict[str, asyncio.Lock] = {}
+        # Downloads holding or waiting for each lock, it is dropped with the last one
+        self._lock_users: dict[str, int] = {}
+
+    @property
+    def active(self) -> list[DownloadTask]:
+        return [task for task in self.tasks if task.status in ("waiting", "downloading", "verifying")]
+
+    async def download(self, group: StealthIM.Group, file_hash: str, path: str) -> DownloadTask:
+        task = DownloadTask(os.path.basename(path), path, group=group, hash=file_hash,
+                            part_path=self.store.part_path(file_hash))
+        self.tasks.append(task)
+        self._notify(task)
+        try:
+            async with self._hash_lock(file_hash):
+                if os.path.exists(task.path) and self.store.is_materialized(file_hash, task.path):
+                    task.note = "already downloaded"
+                elif self.store.has(file_hash):
+                    task.note = "from local store"
+                else:
+                    async with self._semaphore:
+                        await self._download(task)
+                if not os.path.exists(task.path):
+                    self.store.materialize(file_hash, task.path)
+                task.done = task.size = os.path.getsize(task.path)
+                task.status = "done"
+        except (RuntimeError, OSError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Download of {file_hash} failed: {e}")
+            task.status = "failed"
+            task.error = str(e)
+        finally:
+            self._notify(task)
+        return task
+
+    @asynccontextmanager
+    async def _hash_lock(self, file_hash: str):
+        lock = self._locks.setdefault(file_hash, asyncio.Lock())
+        self._lock_users[file_hash] = self._lock_users.get(file_hash, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._lock_users[file_hash] -= 1
+            if not self._lock_users[file_hash]:
+                del self._lock_users[file_hash]
+                del self._locks[file_hash]
+
+    def pick_path(self, output_dir: str, filename: str, file_hash: str) -> str:
+        """A free path for the file, or the one this file was already saved to."""
+        base, ext = os.path.splitext(filename)
+        i = 0
+        while True:
+            path = os.path.join(output_dir, f"{base}({i}){ext}" if i else filename)
+            if not os.path.exists(path) or self.store.is_materialized(file_hash, path):
+                return path
+            i += 1
+
+    def clear_finished(self) -> None:
+        self.tasks = self.active
+
+    async def _download(self, task: DownloadTask) -> None:
+        """Fetch the file into the blob store."""
+        task.status = "downloading"
+        task.size = await db.get_file_size(task.group, task.hash)
+        if not task.size:
+            raise RuntimeError("Failed to get file size")
+        total_blocks = (task.size + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+        finished = self._load_finished(task)
+        task.done = sum(self._block_length(task, block) for block in finished)
+        task.sample()
+
+        missing = [block for block in range(total_blocks) if block not in finished]
+        os.makedirs(os.path.dirname(task.part_path), exist_ok=True)
+        self._save_finished(task, sorted(finished))
+        task.saved_at = time.monotonic()
+        mode = "r+b" if os.path.exists(task.part_path) else "wb"
+        with open(task.part_path, mode) as f:
+            f.truncate(task.size)
+            try:
+                try:
+                    await self._gather(*(
+                        self._fetch(task, f, finished, start, end) for start, end in self._split(missing)
+                    ))
+                except RangeNotSupported:
+                    # Fall back to one plain request for the whole file
+                    logger.info(f"Server ignored Range for {task.hash}, downloading the whole file")
+                    finished.clear()
+                    task.done = 0
+                    await self._fetch(task, f, finished, None, None)
+            finally:
+                # Also what was fetched before a failure, for the next attempt
+                await self._save_progress(task, f, finished)
+
+        task.status = "verifying"
+        self._notify(task)
+        file_hash = await hash_file(task.part_path)
+        if file_hash != task.hash:
+            os.remove(task.part_path)
+            os.remove(task.blocks_path)
+            raise RuntimeError("File hash mismatch")
+
+        self.store.add(task.hash, task.part_path)
+        os.remove(task.blocks_path)
+
+    @staticmethod
+    async def _gather(*coros) -> None:
+        """Like asyncio.gather, but the other ranges are cancelled as soon as one fails."""
+        tasks = [asyncio.create_task(coro) for coro in coros]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def _split(self, blocks: list[int]) -> list[tuple[int, int]]:
+        """Group missing blocks into at most RANGES_PER_FILE contiguous block ranges."""
+        runs: list[list[int]] = []
+        for block in blocks:
+            if runs and runs[-1][1] == block - 1:
+                runs[-1][1] = block
+            else:
+                runs.append([block, block])
+        # Cut the longest runs until there are enough ranges to run in parallel
+        while len(runs) < self.RANGES_PER_FILE:
+            longest = max(runs, key=lambda r: r[1] - r[0], default=None)
+            if longest is None or longest[0] == longest[1]:
+                break
+            middle = (longest[0] + longest[1]) // 2
+            runs.append([middle + 1, longest[1]])
+            longest[1] = middle
+        return [(start, end) for start, end in sorted(runs)]
+
+    async def _fetch(self, task: DownloadTask, f, finished: set[int],
+                     start: Optional[int], end: Optional[int]) -> None:
+        range_header = None
+        if start is not None:
+            last_byte = min((end + 1) * BLOCK_SIZE, task.size) - 1
+            range_header = f"bytes={start * BLOCK_SIZE}-{last_byte}"
+        user = task.group.user
+        total_blocks = (task.size + BLOCK_SIZE - 1) // BLOCK_SIZE
+        async for offset, data in stream_blocks(user.server.url, user.session, task.hash, range_header):
+            block = offset // BLOCK_SIZE
+            if start is not None and not start <= block <= end:
+                raise RangeNotSupported()
+            if block >= total_blocks or len(data) != self._block_length(task, block):
+                raise RuntimeError(f"Bad block {block} from server")
+            if block in finished:
+                continue
+            await asyncio.get_running_loop().run_in_executor(file_executor, write_block, f, offset, data)
+            finished.add(block)
+            task.unsaved += 1
+            if task.unsaved >= self.SAVE_BLOCKS or time.monotonic() - task.saved_at >= self.SAVE_INTERVAL:
+                await self._save_progress(task, f, finished)
+            task.done += len(data)
+            task.sample()
+            self._notify(task)
+
+    @staticmethod
+    def _block_length(task: DownloadTask, block: int) -> int:
+        return min(BLOCK_SIZE, task.size - block * BLOCK_SIZE)
+
+    @staticmethod
+    def _read_blocks(task: DownloadTask) -> Optional[dict]:
+        if not (os.path.exists(task.part_path) and os.path.exists(task.blocks_path)):
+            return None
+        try:
+            with open(task.blocks_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("hash") != task.hash:
+            return None
+        return data
+
+    @staticmethod
+    def _load_finished(task: DownloadTask) -> set[int]:
+        data = DownloadManager._read_blocks(task)
+        return set(data["blocks"]) if data else set()
+
+    async def _save_progress(self, task: DownloadTask, f, finished: set[int]) -> None:
+        """Record the finished blocks, after the writes before them reached the file."""
+        task.unsaved = 0
+        task.saved_at = time.monotonic()
+        await asyncio.get_running_loop().run_in_executor(file_executor, self._flush_finished, task, f, sorted(finished))
+
+    @staticmethod
+    def _flush_finished(task: DownloadTask, f, blocks: list[int]) -> None:
+        f.flush()
+        DownloadManager._save_finished(task, blocks)
+
+    @staticmethod
+    def _save_finished(task: DownloadTask, blocks: list[int]) -> None:
+        with open(task.blocks_path, "w", encoding="utf-8") as f:
+            json.dump({"hash": task.hash, "blocks": blocks}, f)
+
+    def _notify(self, task: DownloadTask) -> None:
+        if self.on_progress:
+            self.on_progress(task)
+
+
+class UploadManager:
+    """Uploads files to a group over the file websocket.
+
+    The file is streamed block by block and never held in memory. The server needs the
+    file hash before the first block, so hashing runs in the hash thread pool while the
+    websocket is being opened, and the upload stops right there when the server reports
+    that it already has the content.
+    """
+    MAX_CONCURRENT = 2
+
+    def __init__(self, on_progress: Optional[Callable[[UploadTask], None]] = None):
+        self.tasks: list[UploadTask] = []
+        self.on_progress = on_progress
+        self._semaphore = asyncio.Semaphore(self.MAX_CONCURRENT)
+
+    @property
+    def active(self) -> list[UploadTask]:
+        return [task for task in self.tasks if task.status in ("waiting", "hashing", "uploading")]
+
+    def clear_finished(self) -> None:
+        self.tasks = self.active
+
+    async def upload(self, group: StealthIM.Group, path: str) -> UploadTask:
+        task = UploadTask(os.path.basename(path), path)
+        self.tasks.append(task)
+        self._notify(task)
+        try:
+            async with self._semaphore:
+                await self._upload(group, task)
+        except (RuntimeError, OSError, ValueError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Upload of {path} failed: {e}")
+            task.status = "failed"
+            task.error = str(e)
+        finally:
+            self._notify(task)
+        return task
+
+    async def _upload(self, group: StealthIM.Group, task: UploadTask) -> None:
+        task.size = os.path.getsize(task.path)
+        task.status = "hashing"
+        self._notify(task)
+
+        api_address = f"{group.user.server.url}/api/v1/file/"
+        api_address = api_address.replace("https", "wss").replace("http", "ws")
+        header = {
+            "Authorization": f"Bearer {group.user.session}"
+        }
+        async with aiohttp.ClientSession() as client:
+            # Connect while hashing, both take a while
+            file_hash, ws = await asyncio.gather(
+                hash_file(task.path),
+                client.ws_connect(api_address, headers=header),
+            )
+            async with ws:
+                await ws.send_str(json.dumps({
+                    "size": str(task.size),
+                    "groupid": str(group.group_id),
+                    "hash": file_hash,
+                    "filename": task.filename[:30],
+                }))
+                code = await self._receive_code(ws)
+                if code == codes.FILE_REPEATED_FILE:
+                    task.repeated = True
+                    task.note = "already on server"
+                    task.done = task.size
+                    task.status = "done"
+                    return
+                if code != 0:
+                    raise RuntimeError(f"{code} ({codes.get_msg(code)})")
+
+                task.status = "uploading"
+                blocks = (task.size + BLOCK_SIZE - 1) // BLOCK_SIZE
+                for block_id in range(blocks):
+                    block = await asyncio.to_thread(read_block, task.path, block_id)
+                    await ws.send_bytes(struct.pack("<I", block_id) + block)
+                    code = await self._receive_code(ws)
+                    if code != 0:
+                        raise RuntimeError(f"{code} ({codes.get_msg(code)})")
+                    task.done += len(block)
+                    task.sample()
+                    self._notify(task)
+
+                code = await self._receive_code(ws)
+                if code not in (0, codes.SUCCESS):
+                    raise RuntimeError(f"{code} ({codes.get_msg(code)})")
+        task.status = "done"
+
+    @staticmethod
+    async def _receive_code(ws: aiohttp.ClientWebSocketResponse) -> int:
+        msg = await ws.receive()
+        if msg.type != aiohttp.WSMsgType.TEXT:
+            raise RuntimeError(f"Upload connection closed ({msg.type.name})")
+        return json.loads(msg.data).get("result", {}).get("code", -1)
+
+    def _notify(self, task: UploadTask) -> None:
+        if self.on_progress:
+            self.on_progress(task)